@@ -0,0 +1,80 @@
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Case, When, Value, DateTimeField
+import django.utils.timezone
+
+from .db import split_for_query, closes_connection
+
+import logging
+logger = logging.getLogger('connector.apps')
+
+
+# last_seen_at of users is collected in memory and written periodically with one UPDATE per chunk
+class ActivityTracker:
+    _lock = threading.Lock()
+    _pending = {}
+    _recorded_at = {}
+    _timer = None
+
+    @classmethod
+    def get_granularity_seconds(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('ACTIVITY_GRANULARITY_SECONDS', 60)
+
+    @classmethod
+    def get_flush_seconds(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('ACTIVITY_FLUSH_SECONDS', 60)
+
+    @classmethod
+    def touch(cls, user_id, seen_at=None):
+        if seen_at is None:
+            seen_at = django.utils.timezone.now()
+
+        now = time.monotonic()
+        with cls._lock:
+            recorded_at = cls._recorded_at.get(user_id)
+            if recorded_at is not None and now - recorded_at < cls.get_granularity_seconds():
+                return
+            cls._recorded_at[user_id] = now
+            cls._pending[user_id] = seen_at
+
+            if cls._timer is None:
+                cls._timer = threading.Timer(cls.get_flush_seconds(), cls._fire)
+                cls._timer.daemon = True
+                cls._timer.start()
+
+    @classmethod
+    @closes_connection
+    def _fire(cls):
+        with cls._lock:
+            cls._timer = None
+
+        cls.flush()
+
+    @classmethod
+    def flush(cls):
+        from .models import User
+
+        now = time.monotonic()
+        with cls._lock:
+            pending, cls._pending = cls._pending, {}
+            # users who weren't seen for a while are forgotten, so memory stays flat
+            cls._recorded_at = {
+                user_id: recorded_at for user_id, recorded_at in cls._recorded_at.items()
+                if now - recorded_at < cls.get_granularity_seconds()
+            }
+
+        # three query parameters per user
+        for chunk in split_for_query(pending.keys(), parameters_per_item=3):
+            try:
+                User.objects.filter(id__in=chunk).update(last_seen_at=Case(
+                    *[When(id=user_id, then=Value(pending[user_id], output_field=DateTimeField())) for user_id in chunk],
+                    output_field=DateTimeField()
+                ))
+            except Exception as e:
+                logger.error(e)
+
+
+atexit.register(ActivityTracker.flush)
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django import forms
-from .models import Group, User, UserState, Meeting, Invitation, Feedback, Message
+from .models import Group, User, UserState, Meeting, Invitation, Feedback, Message, MessageArchive, Broadcast, BroadcastDelivery
 
 
 # Register your models here.
@@ -24,7 +24,9 @@ class UserStateForm(forms.ModelForm):
 
 class UserStateAdmin(admin.ModelAdmin):
     form = UserStateForm
-    list_display = ('user', 'context', 'updated_at')
+    list_display = ('user', 'context', 'version', 'updated_at')
+    # version is changed by every save, editing it would hide the change from cached dialogs
+    readonly_fields = ('version',)
 
 
 class InvitationForm(forms.ModelForm):
@@ -69,6 +71,19 @@ class MessageForm(forms.ModelForm):
 class MessageAdmin(admin.ModelAdmin):
     form = MessageForm
     list_display = ('sent_at', 'message_id', 'direction', 'user', 'text')
+    list_select_related = ('user',)
+    date_hierarchy = 'sent_at'
+
+
+class MessageArchiveForm(forms.ModelForm):
+    class Meta:
+        model = MessageArchive
+        fields = '__all__'
+
+
+class MessageArchiveAdmin(admin.ModelAdmin):
+    form = MessageArchiveForm
+    list_display = ('year', 'week', 'messages_count', 'size_bytes', 'file_path', 'updated_at')
 
 
 class FeedbackForm(forms.ModelForm):
@@ -82,6 +97,29 @@ class FeedbackAdmin(admin.ModelAdmin):
     list_display = ('sent_at', 'user', 'text')
 
 
+class BroadcastForm(forms.ModelForm):
+    class Meta:
+        model = Broadcast
+        fields = '__all__'
+
+
+class BroadcastAdmin(admin.ModelAdmin):
+    form = BroadcastForm
+    list_display = ('year', 'week', 'created_at', 'finished_at')
+
+
+class BroadcastDeliveryForm(forms.ModelForm):
+    class Meta:
+        model = BroadcastDelivery
+        fields = '__all__'
+
+
+class BroadcastDeliveryAdmin(admin.ModelAdmin):
+    form = BroadcastDeliveryForm
+    list_display = ('broadcast', 'user_telegram_id', 'status', 'attempts', 'sent_at', 'error')
+    list_filter = ('status',)
+
+
 admin.site.register(Group, GroupAdmin)
 admin.site.register(User, UserAdmin)
 admin.site.register(UserState, UserStateAdmin)
@@ -89,3 +127,6 @@ admin.site.register(Invitation, InvitationAdmin)
 admin.site.register(Meeting, MeetingAdmin)
 admin.site.register(Feedback, FeedbackAdmin)
 admin.site.register(Message, MessageAdmin)
+admin.site.register(MessageArchive, MessageArchiveAdmin)
+admin.site.register(Broadcast, BroadcastAdmin)
+admin.site.register(BroadcastDelivery, BroadcastDeliveryAdmin)
@@ -0,0 +1,118 @@
+import atexit
+import queue
+import threading
+import time
+
+from django.conf import settings
+import django.utils.timezone
+
+from .db import closes_connection
+
+import logging
+logger = logging.getLogger('connector.apps')
+
+
+_STOP = object()
+
+
+# Message records are written in background with bulk_create, so logging never delays a reply
+class AuditLog:
+    _lock = threading.Lock()
+    _queue = None
+    _worker = None
+    dropped = 0
+
+    @classmethod
+    def get_queue_size(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('AUDIT_LOG_QUEUE_SIZE', 10000)
+
+    @classmethod
+    def get_batch_size(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('AUDIT_LOG_BATCH_SIZE', 100)
+
+    @classmethod
+    def get_flush_seconds(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('AUDIT_LOG_FLUSH_SECONDS', 2)
+
+    # takes the same arguments as Message
+    @classmethod
+    def record(cls, **kwargs):
+        from .models import Message
+
+        if kwargs.get('sent_at') is None:
+            kwargs['sent_at'] = django.utils.timezone.now()
+
+        # bulk_create doesn't call save()
+        message = Message(**kwargs)
+        message.set_iso_week()
+
+        cls._start()
+        try:
+            cls._queue.put_nowait(message)
+        except queue.Full:
+            with cls._lock:
+                cls.dropped += 1
+                dropped = cls.dropped
+            if dropped == 1 or dropped % 100 == 0:
+                logger.error("audit log queue is full, %d messages dropped so far" % dropped)
+
+    @classmethod
+    def _start(cls):
+        with cls._lock:
+            if cls._worker is not None:
+                return
+            cls._queue = queue.Queue(maxsize=cls.get_queue_size())
+            cls._worker = threading.Thread(target=cls._work, daemon=True)
+            cls._worker.start()
+
+    @classmethod
+    def _work(cls):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = cls._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                cls._write(batch)
+                return
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + cls.get_flush_seconds()
+
+            if len(batch) >= cls.get_batch_size() or (deadline is not None and time.monotonic() >= deadline):
+                cls._write(batch)
+                batch = []
+                deadline = None
+
+    @classmethod
+    @closes_connection
+    def _write(cls, batch):
+        from .models import Message
+
+        if len(batch) == 0:
+            return
+        try:
+            Message.objects.bulk_create(batch)
+        except Exception as e:
+            logger.error(e)
+
+    # writes everything buffered and stops the worker, next record starts a new one
+    @classmethod
+    def flush(cls, timeout=10):
+        with cls._lock:
+            worker, cls._worker = cls._worker, None
+            buffer = cls._queue
+        if worker is None:
+            return
+
+        buffer.put(_STOP)
+        worker.join(timeout=timeout)
+
+
+atexit.register(AuditLog.flush)
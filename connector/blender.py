@@ -1,81 +1,434 @@
+import copy
+import itertools
 import random
+from collections import deque
 
-from .models import User, Invitation, Meeting
+from .models import Invitation, Meeting
 from .clock import Clock
+from .db import MAX_QUERY_PARAMETERS
 
+from django.conf import settings
 from django.db.models import Q
 
 import logging
 logger = logging.getLogger('connector.apps')
 
-def update_possible_partners(profiles_dict, history_dict, capacity_dict):
-    possible_partners = {}
-    for u_id in capacity_dict:
-        possible_partners[u_id] = []
-        for u_id_2 in capacity_dict:
-            if (not u_id_2 == u_id) and (not u_id_2 in history_dict[u_id]) and \
-                    (capacity_dict[u_id] > 0) and \
-                    (capacity_dict[u_id_2] > 0) and \
-                    (
-                            (profiles_dict[u_id]['group_name'] == '' and profiles_dict[u_id_2]['group_name'] == '') or
-                            (profiles_dict[u_id]['group_name'] != profiles_dict[u_id_2]['group_name'])
-                    ) and \
-                    (
-                            (profiles_dict[u_id]['motivation'] != 'D') or \
-                            (profiles_dict[u_id]['motivation'] == 'D' and profiles_dict[u_id]['gender'] != profiles_dict[u_id_2]['gender'])
-                    ):
-                possible_partners[u_id].append(u_id_2)
-    return possible_partners
-
-
-def arrange_meetings(year=None, week=None):
-    if week is None or year is None:
-        raise Exception("Error: WEEK or YEAR are not specified")
+# same predicate as CompatibilityIndex.accepts() without history, computed with NumPy by blocks of rows,
+# every row is packed into a bitmask of participants in the order of profiles_dict
+def build_compatibility_matrix(profiles_dict, block_size=1024):
+    import numpy as np
+
+    participants_id = list(profiles_dict.keys())
+
+    def encode(field, blank=None):
+        codes = {blank: 0}
+        return np.array([codes.setdefault(profiles_dict[u_id][field], len(codes)) for u_id in participants_id])
+
+    group = encode('group_name', blank='')
+    gender = encode('gender')
+    dating = np.array([profiles_dict[u_id]['motivation'] == 'D' for u_id in participants_id], dtype=bool)
+    no_group = group == 0
+
+    rows = []
+    for first in range(0, len(participants_id), block_size):
+        block = slice(first, first + block_size)
+        allowed = (group[block, None] != group[None, :]) | (no_group[block, None] & no_group[None, :])
+        allowed &= ~dating[block, None] | (gender[block, None] != gender[None, :])
+        for i, row in enumerate(np.packbits(allowed, axis=1, bitorder='little'), start=first):
+            rows.append(int.from_bytes(row.tobytes(), 'little') & ~(1 << i))
+    return rows
+
+
+# how many random probes pick() makes before counting candidates exactly
+PICK_ATTEMPTS = 8
+
+BIT_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+# possible partners of every participant, built once per matching run and never copied
+# participants are numbered in the order of profiles_dict, sets of participants are bitmasks (python int)
+class CompatibilityIndex:
+    def __init__(self, profiles_dict, history_dict, rows=None):
+        self.participants_id = list(profiles_dict.keys())
+        self.position = {u_id: i for i, u_id in enumerate(self.participants_id)}
+        self.everyone = (1 << len(self.participants_id)) - 1
+        self.rows = rows
+
+        self.groups = []
+        self.genders = []
+        self.dating = []
+        self.group_members = {}
+        self.gender_members = {}
+        for i, u_id in enumerate(self.participants_id):
+            profile = profiles_dict[u_id]
+            self.groups.append(profile['group_name'])
+            self.genders.append(profile['gender'])
+            self.dating.append(profile['motivation'] == 'D')
+            if profile['group_name'] != '':
+                self.group_members[profile['group_name']] = self.group_members.get(profile['group_name'], 0) | (1 << i)
+            self.gender_members[profile['gender']] = self.gender_members.get(profile['gender'], 0) | (1 << i)
+
+        # history is sparse, so it stays a set of positions and is checked for the picked candidate only
+        self.history = []
+        for i, u_id in enumerate(self.participants_id):
+            forbidden = {i}
+            for u_id_2 in history_dict.get(u_id, []):
+                if u_id_2 in self.position:
+                    forbidden.add(self.position[u_id_2])
+            self.history.append(forbidden)
+
+    @classmethod
+    def from_profiles(cls, profiles_dict, history_dict):
+        return cls(profiles_dict, history_dict)
+
+    @classmethod
+    def from_profiles_vectorized(cls, profiles_dict, history_dict):
+        return cls(profiles_dict, history_dict, rows=build_compatibility_matrix(profiles_dict))
+
+    def mask_of(self, participants_id):
+        mask = 0
+        for u_id in participants_id:
+            mask |= 1 << self.position[u_id]
+        return mask
+
+    @staticmethod
+    def positions(mask):
+        flags = bin(mask)[:1:-1].encode().translate(BIT_FLAGS)
+        return list(itertools.compress(range(0, len(flags)), flags))
+
+    # position of k-th set bit, bits are written from the lowest one, blocks are counted from large to small
+    @staticmethod
+    def select(bits, k):
+        start = 0
+        for block in (4096, 64, 1):
+            count = bits.count('1', start, start + block)
+            while k >= count:
+                k -= count
+                start += block
+                count = bits.count('1', start, start + block)
+        return start
+
+    # everyone participant i can be matched with, history aside
+    def acceptable(self, i):
+        if self.rows is not None:
+            return self.rows[i]
+        mask = self.everyone & ~(1 << i)
+        if self.groups[i] != '':
+            mask &= ~self.group_members[self.groups[i]]
+        if self.dating[i]:
+            mask &= ~self.gender_members[self.genders[i]]
+        return mask
+
+    def accepts(self, i, j):
+        return j not in self.history[i] and \
+               (self.groups[i] == '' or self.groups[i] != self.groups[j]) and \
+               (not self.dating[i] or self.genders[i] != self.genders[j])
+
+    def candidates_mask(self, i, available, excluded=()):
+        mask = self.acceptable(i) & available
+        for j in itertools.chain(self.history[i], excluded):
+            if (mask >> j) & 1:
+                mask &= ~(1 << j)
+        return mask
+
+    def candidates(self, i, available, excluded=()):
+        return self.positions(self.candidates_mask(i, available, excluded))
+
+    # random candidate of participant i among available ones, None if nobody is left
+    def pick(self, i, available, excluded, rng):
+        mask = self.acceptable(i) & available
+        if mask == 0:
+            return None
+
+        # candidates are usually dense, so a few random probes find one without listing them
+        size = mask.bit_length()
+        forbidden = self.history[i]
+        for attempt in range(0, PICK_ATTEMPTS):
+            j = rng.randrange(size)
+            if (mask >> j) & 1 and j not in forbidden and j not in excluded:
+                return j
+
+        bits = bin(self.candidates_mask(i, available, excluded))[:1:-1]
+        count = bits.count('1')
+        if count == 0:
+            return None
+        return self.select(bits, rng.randrange(count))
+
+    def as_dict(self, available):
+        possible_partners = {}
+        for i, u_id in enumerate(self.participants_id):
+            if (available >> i) & 1:
+                possible_partners[u_id] = list(map(self.participants_id.__getitem__, self.candidates(i, available)))
+            else:
+                possible_partners[u_id] = []
+        return possible_partners
 
-    participants = Invitation.objects.filter(week=week, year=year, accepted=True)
 
-    if len(participants) == 0:
-        return {}
+def count_unsatisfied(meetings, capacity_dict):
+    capacity_left = dict(capacity_dict)
+    for u_id, u_id_2 in meetings:
+        capacity_left[u_id] -= 1
+        capacity_left[u_id_2] -= 1
+
+    participants_without_meeting = list(filter(lambda x: capacity_left[x] == capacity_dict[x], capacity_left))
+    participants_with_less_meetings_than_expected = list(filter(lambda x: capacity_left[x] > 0, capacity_left))
+    return len(participants_without_meeting), len(participants_with_less_meetings_than_expected)
+
+
+SHUFFLE_ITERATION = 5
+
+
+# random greedy passes over participants, the best pass by left alone/left underutilized wins
+def solve_by_shuffling(participants_id, compatibility_index, capacity_dict_initial, rng):
+    optimal_set_of_meetings = []
+    min_participants_without_meeting = len(participants_id)
+    min_participants_with_less_meetings_than_expected = len(participants_id)
 
-    participants_id = list(map(lambda x: x.user.telegram_id, participants))
+    available_initial = compatibility_index.mask_of([u_id for u_id in participants_id if capacity_dict_initial[u_id] > 0])
 
-    participants_data = User.objects.filter(telegram_id__in=participants_id)
+    for it in range(0, SHUFFLE_ITERATION):
+        meetings = []
+        capacity_dict = dict(capacity_dict_initial)
+        available = available_initial
+        met = {}
+
+        for u_id in participants_id:
+            if capacity_dict[u_id] > 0:
+                i = compatibility_index.position[u_id]
+                j = compatibility_index.pick(i, available, met.get(i, ()), rng)
+                if j is None:
+                    continue
+                partner_id = compatibility_index.participants_id[j]
+
+                meetings.append((u_id, partner_id))
+                met.setdefault(i, set()).add(j)
+                met.setdefault(j, set()).add(i)
+                capacity_dict[u_id] -= 1
+                capacity_dict[partner_id] -= 1
+
+                for p_id, p in ((u_id, i), (partner_id, j)):
+                    if capacity_dict[p_id] == 0:
+                        available &= ~(1 << p)
+
+        participants_without_meeting, participants_with_less_meetings_than_expected = count_unsatisfied(meetings, capacity_dict_initial)
+
+        if participants_without_meeting == 0 and participants_with_less_meetings_than_expected == 0:
+            return meetings
+        else:
+            if participants_without_meeting < min_participants_without_meeting:
+                if participants_with_less_meetings_than_expected < min_participants_with_less_meetings_than_expected:
+                    optimal_set_of_meetings = meetings
+                    min_participants_without_meeting = participants_without_meeting
+                    min_participants_with_less_meetings_than_expected = participants_with_less_meetings_than_expected
+
+    return optimal_set_of_meetings
+
+
+# maximum b-matching: participant with capacity c is split into c copies, Edmonds' blossom algorithm matches copies
+def solve_by_max_matching(participants_id, compatibility_index, capacity_dict_initial, rng):
+    index = compatibility_index
+    available = index.mask_of([u_id for u_id in participants_id if capacity_dict_initial[u_id] > 0])
+    mutual = {}
+    for u_id in participants_id:
+        i = index.position[u_id]
+        if (available >> i) & 1:
+            mutual[u_id] = [index.participants_id[j] for j in index.candidates(i, available) if index.accepts(j, i)]
+        else:
+            mutual[u_id] = []
+        rng.shuffle(mutual[u_id])
+
+    owner = []
+    copies = {}
+    for u_id in participants_id:
+        copies[u_id] = []
+        for c in range(0, capacity_dict_initial[u_id]):
+            copies[u_id].append(len(owner))
+            owner.append(u_id)
+
+    n = len(owner)
+    match = [-1] * n
+    pairs_matched = {}
+
+    def pair_key(v, to):
+        return (owner[v], owner[to]) if owner[v] < owner[to] else (owner[to], owner[v])
+
+    def set_match(v, to):
+        match[v] = to
+        match[to] = v
+        pairs_matched[pair_key(v, to)] = pairs_matched.get(pair_key(v, to), 0) + 1
+
+    def unset_match(v):
+        pairs_matched[pair_key(v, match[v])] -= 1
+        match[match[v]] = -1
+        match[v] = -1
+
+    def neighbours(v):
+        for u_id_2 in mutual[owner[v]]:
+            for to in copies[u_id_2]:
+                if match[v] == to or pairs_matched.get(pair_key(v, to), 0) == 0:
+                    yield to
+
+    # greedy start, augmenting paths only have to fix what is left
+    for u_id in rng.sample(participants_id, len(participants_id)):
+        for v in copies[u_id]:
+            if match[v] != -1:
+                continue
+            for to in neighbours(v):
+                if match[to] == -1:
+                    set_match(v, to)
+                    break
+
+    def find_augmenting_path(root):
+        used = [False] * n
+        parent = [-1] * n
+        base = list(range(n))
+
+        def lowest_common_ancestor(a, b):
+            visited = [False] * n
+            while True:
+                a = base[a]
+                visited[a] = True
+                if match[a] == -1:
+                    break
+                a = parent[match[a]]
+            while True:
+                b = base[b]
+                if visited[b]:
+                    return b
+                b = parent[match[b]]
+
+        def mark_path(v, b, child, blossom):
+            while base[v] != b:
+                blossom[base[v]] = blossom[base[match[v]]] = True
+                parent[v] = child
+                child = match[v]
+                v = parent[match[v]]
+
+        used[root] = True
+        queue = deque([root])
+        while queue:
+            v = queue.popleft()
+            for to in neighbours(v):
+                if base[v] == base[to] or match[v] == to:
+                    continue
+                if to == root or (match[to] != -1 and parent[match[to]] != -1):
+                    # odd cycle found, contracting it into a blossom
+                    current_base = lowest_common_ancestor(v, to)
+                    blossom = [False] * n
+                    mark_path(v, current_base, to, blossom)
+                    mark_path(to, current_base, v, blossom)
+                    for i in range(0, n):
+                        if blossom[base[i]]:
+                            base[i] = current_base
+                            if not used[i]:
+                                used[i] = True
+                                queue.append(i)
+                elif parent[to] == -1:
+                    parent[to] = v
+                    if match[to] == -1:
+                        return to, parent
+                    used[match[to]] = True
+                    queue.append(match[to])
+        return -1, parent
+
+    def augment(root):
+        to, parent = find_augmenting_path(root)
+        if to == -1:
+            return False
+        while to != -1:
+            v = parent[to]
+            next_to = match[v]
+            if next_to != -1:
+                unset_match(v)
+            set_match(v, to)
+            to = next_to
+        return True
+
+    # one augmenting path may bring the same pair together through two different copies,
+    # such duplicates are split and their copies get another chance to find a partner
+    for it in range(0, n + 1):
+        for v in rng.sample(range(0, n), n):
+            if match[v] == -1:
+                augment(v)
+
+        duplicates = [v for v in range(0, n) if match[v] > v and pairs_matched[pair_key(v, match[v])] > 1]
+        if len(duplicates) == 0:
+            break
+        for v in duplicates:
+            if pairs_matched[pair_key(v, match[v])] > 1:
+                unset_match(v)
+
+    meetings = []
+    for v in range(0, n):
+        if match[v] > v:
+            meetings.append((owner[v], owner[match[v]]))
+    return meetings
+
+
+SOLVERS = {
+    'shuffle': solve_by_shuffling,
+    'max_matching': solve_by_max_matching,
+}
+
+
+# profiles of everyone who accepted invitation for the week, fetched with one joined query
+def load_profiles(year, week):
+    participants = Invitation.objects \
+        .filter(week=week, year=year, accepted=True) \
+        .order_by('id') \
+        .values('user__telegram_id', 'user__group__name', 'user__gender', 'user__meeting_frequency', 'user__meeting_motivation')
 
     profiles_dict = {}
-    for p in participants_data:
-        profiles_dict[p.telegram_id] = {
-            'group_name': p.group_name,
-            'gender': p.gender,
-            'frequency': p.meeting_frequency,
-            'motivation': p.meeting_motivation
+    for p in participants:
+        profiles_dict[p['user__telegram_id']] = {
+            'group_name': p['user__group__name'] if p['user__group__name'] is not None else '',
+            'gender': p['user__gender'],
+            'frequency': p['user__meeting_frequency'],
+            'motivation': p['user__meeting_motivation']
         }
+    return profiles_dict
+
+
+# two query parameters per participant
+HISTORY_FILTER_LIMIT = MAX_QUERY_PARAMETERS // 2
 
+
+# partners every participant has already met: telegram_id -> list of telegram_id
+def load_history(participants_id):
     history_dict = {}
     for p_id in participants_id:
-        p_id_str = str(p_id)
-        unique_participants = []
+        history_dict[str(p_id)] = set()
 
-        # doing two lookups to cover all options
-        # USER -> PARTICIPANT & PARTICIPANT -> USER
-        participants_b = Meeting.objects.filter(Q(user_a_telegram_id=p_id_str) & (Q(user_a_meeting_took_place=True) | Q(user_b_meeting_took_place=True)))
-        for pB in participants_b:
-            unique_participants.append(pB.user_b_telegram_id)
+    if len(history_dict) == 0:
+        return {}
 
-        participants_a = Meeting.objects.filter(Q(user_b_telegram_id=p_id_str) & (Q(user_a_meeting_took_place=True) | Q(user_b_meeting_took_place=True)))
-        for pA in participants_a:
-            unique_participants.append(pA.user_a_telegram_id)
+    meetings_took_place = Meeting.objects \
+        .filter(Q(user_a_meeting_took_place=True) | Q(user_b_meeting_took_place=True)) \
+        .values_list('user_a_telegram_id', 'user_b_telegram_id')
 
-        history_dict[p_id_str] = list(set(unique_participants))
+    # meetings of a few participants are looked up by index, for many of them the whole history is streamed
+    if len(history_dict) <= HISTORY_FILTER_LIMIT:
+        participants_id = list(history_dict.keys())
+        meetings_took_place = meetings_took_place.filter(
+            Q(user_a_telegram_id__in=participants_id) | Q(user_b_telegram_id__in=participants_id))
+
+    # USER -> PARTICIPANT & PARTICIPANT -> USER
+    for user_a_telegram_id, user_b_telegram_id in meetings_took_place.iterator():
+        if user_a_telegram_id in history_dict:
+            history_dict[user_a_telegram_id].add(user_b_telegram_id)
+        if user_b_telegram_id in history_dict:
+            history_dict[user_b_telegram_id].add(user_a_telegram_id)
+
+    return {p_id: list(partners_id) for p_id, partners_id in history_dict.items()}
 
-    import copy
-    history_dict_initial = copy.deepcopy(history_dict)
 
+def get_capacity(year, week, profiles_dict):
     capacity_dict = {}
 
     year_last_week, week_last_week = Clock.get_previous_week_by_year_and_week(year, week)
     participants_previous_week = Meeting.get_participants_id(year=year_last_week, week=week_last_week)
 
-    for p_id in participants_id:
+    for p_id in profiles_dict:
         c = 1
 
         if profiles_dict[p_id]['frequency'] == 'H':
@@ -90,54 +443,69 @@ def arrange_meetings(year=None, week=None):
 
         capacity_dict[p_id] = c
 
-    import copy
-    capacity_dict_initial = copy.deepcopy(capacity_dict)
+    return capacity_dict
 
-    possible_partners_initial = update_possible_partners(profiles_dict, history_dict, capacity_dict)
 
-    optimal_set_of_meetings = []
-    min_participants_without_meeting = len(participants_id)
-    min_participants_with_less_meetings_than_expected = len(participants_id)
+COMPATIBILITY_MODES = ['python', 'numpy']
 
-    SHUFFLE_ITERATION = 5
-    for it in range(0, SHUFFLE_ITERATION):
-        meetings = []
 
-        for u_id in participants_id:
+# matching itself, without database: returns compatibility index and list of meetings
+def match_participants(profiles_dict, history_dict, capacity_dict, compatibility='python', solver='shuffle', rng=None):
+    if rng is None:
+        rng = random.Random()
 
-            print(u_id)
-            possible_partners = update_possible_partners(profiles_dict, history_dict, capacity_dict)
-            print(possible_partners)
+    participants_id = list(profiles_dict.keys())
 
-            if capacity_dict[u_id] > 0:
-                if len(possible_partners[u_id]) == 0:
-                    continue
+    # compatibility doesn't change during the run, so it's computed only once
+    if compatibility == 'numpy':
+        compatibility_index = CompatibilityIndex.from_profiles_vectorized(profiles_dict, history_dict)
+    else:
+        compatibility_index = CompatibilityIndex.from_profiles(profiles_dict, history_dict)
 
-                r = random.randint(0, len(possible_partners[u_id]) - 1)
-                partner_id = possible_partners[u_id][r]
+    meetings = SOLVERS[solver](participants_id, compatibility_index, capacity_dict, rng)
 
-                meetings.append((u_id, partner_id))
-                print((u_id, partner_id))
-                history_dict[u_id].append(partner_id)
-                history_dict[partner_id].append(u_id)
-                capacity_dict[u_id] -= 1
-                capacity_dict[partner_id] -= 1
+    return compatibility_index, meetings
 
-        participants_without_meeting = list(filter(lambda x: capacity_dict[x] == capacity_dict_initial[x], capacity_dict))
-        participants_with_less_meetings_than_expected = list(filter(lambda x: capacity_dict[x] > 0, capacity_dict))
 
-        if len(participants_without_meeting) == 0 and len(participants_with_less_meetings_than_expected) == 0:
-            optimal_set_of_meetings = meetings
-            min_participants_without_meeting = 0
-            min_participants_with_less_meetings_than_expected = 0
-            break
-        else:
-            if len(participants_without_meeting) < min_participants_without_meeting:
-                if len(participants_with_less_meetings_than_expected) < min_participants_with_less_meetings_than_expected:
-                    optimal_set_of_meetings = meetings
-                    min_participants_without_meeting = len(participants_without_meeting)
-                    min_participants_with_less_meetings_than_expected = len(participants_with_less_meetings_than_expected)
+def arrange_meetings(year=None, week=None, compatibility=None, solver=None, seed=None):
+    if week is None or year is None:
+        raise Exception("Error: WEEK or YEAR are not specified")
 
+    if compatibility is None:
+        compatibility = settings.RANDOM_COFFEE_PLATFORM.get('COMPATIBILITY_MODE', 'python')
+    if compatibility not in COMPATIBILITY_MODES:
+        raise Exception("Error: unknown compatibility mode %s" % compatibility)
+
+    if solver is None:
+        solver = settings.RANDOM_COFFEE_PLATFORM.get('MATCHING_SOLVER', 'shuffle')
+    if solver not in SOLVERS:
+        raise Exception("Error: unknown matching solver %s" % solver)
+
+    profiles_dict = load_profiles(year=year, week=week)
+
+    if len(profiles_dict) == 0:
+        return {}
+
+    participants_id = list(profiles_dict.keys())
+
+    history_dict = load_history(participants_id)
+
+    history_dict_initial = copy.deepcopy(history_dict)
+
+    capacity_dict = get_capacity(year=year, week=week, profiles_dict=profiles_dict)
+
+    capacity_dict_initial = copy.deepcopy(capacity_dict)
+
+    rng = random.Random(seed)
+
+    compatibility_index, optimal_set_of_meetings = match_participants(
+        profiles_dict, history_dict, capacity_dict_initial, compatibility=compatibility, solver=solver, rng=rng)
+
+    possible_partners_initial = compatibility_index.as_dict(
+        compatibility_index.mask_of([p_id for p_id in participants_id if capacity_dict_initial[p_id] > 0]))
+
+    min_participants_without_meeting, min_participants_with_less_meetings_than_expected = \
+        count_unsatisfied(optimal_set_of_meetings, capacity_dict_initial)
 
     res = {
         'week': week,
@@ -146,16 +514,144 @@ def arrange_meetings(year=None, week=None):
         'history': history_dict_initial,
         'capacity': capacity_dict_initial,
         'possible_partners': possible_partners_initial,
-        'shuffle_iterations': SHUFFLE_ITERATION,
+        'solver': solver,
+        'seed': seed,
+        'shuffle_iterations': SHUFFLE_ITERATION if solver == 'shuffle' else 0,
         'meetings': optimal_set_of_meetings,
         'left_alone': min_participants_without_meeting,
         'left_underutilized': min_participants_with_less_meetings_than_expected,
         'has_more_people_to_meet': len(list(filter(lambda k: len(possible_partners_initial[k]) > 0, possible_partners_initial.keys())))
     }
 
-    print(res)
+    logger.info("arranged %d meetings for year=%d, week=%d, left alone: %d, left underutilized: %d" %
+                (len(optimal_set_of_meetings), year, week, min_participants_without_meeting, min_participants_with_less_meetings_than_expected))
 
     return res
 
 
+# only meetings of the participant whose decision has changed are added, removed or rewired
+def repair_meetings(year=None, week=None, telegram_id=None, seed=None):
+    if week is None or year is None or telegram_id is None:
+        raise Exception("Error: WEEK, YEAR or TELEGRAM_ID are not specified")
+
+    telegram_id = str(telegram_id)
+    rng = random.Random(seed)
+
+    profiles_dict = load_profiles(year=year, week=week)
+    capacity_dict = get_capacity(year=year, week=week, profiles_dict=profiles_dict)
+
+    partners_of = {}
+    for user_a_telegram_id, user_b_telegram_id in Meeting.objects.filter(year=year, week=week) \
+            .values_list('user_a_telegram_id', 'user_b_telegram_id'):
+        partners_of.setdefault(user_a_telegram_id, set()).add(user_b_telegram_id)
+        partners_of.setdefault(user_b_telegram_id, set()).add(user_a_telegram_id)
+    partners_of.setdefault(telegram_id, set())
+
+    meetings_added = []
+    meetings_removed = []
+
+    def add_meeting(u_id, u_id_2):
+        partners_of.setdefault(u_id, set()).add(u_id_2)
+        partners_of.setdefault(u_id_2, set()).add(u_id)
+        meetings_added.append((u_id, u_id_2))
+
+    def remove_meeting(u_id, u_id_2):
+        partners_of[u_id].discard(u_id_2)
+        partners_of[u_id_2].discard(u_id)
+        for m in [(u_id, u_id_2), (u_id_2, u_id)]:
+            if m in meetings_added:
+                meetings_added.remove(m)
+                return
+        meetings_removed.append((u_id, u_id_2))
+
+    def result():
+        logger.info("repaired meetings of %s: %d added, %d removed" % (telegram_id, len(meetings_added), len(meetings_removed)))
+        return {
+            'week': week,
+            'year': year,
+            'incremental': True,
+            'telegram_id': telegram_id,
+            'meetings': meetings_added,
+            'removed': meetings_removed
+        }
+
+    def free_capacity(u_id):
+        if u_id not in profiles_dict:
+            return 0
+        return capacity_dict[u_id] - len(partners_of.get(u_id, []))
+
+    # participant left or needs less meetings than before
+    former_partners_id = sorted(partners_of[telegram_id])
+    rng.shuffle(former_partners_id)
+    for u_id_2 in former_partners_id:
+        if free_capacity(telegram_id) < 0 or telegram_id not in profiles_dict:
+            remove_meeting(telegram_id, u_id_2)
+    former_partners_id = [u_id_2 for u_id_2 in former_partners_id if u_id_2 not in partners_of[telegram_id]]
+
+    affected_id = [u_id for u_id in [telegram_id] + former_partners_id if free_capacity(u_id) > 0]
+    if len(affected_id) == 0:
+        return result()
+
+    # new partners are searched only among participants with free capacity,
+    # so only their history is needed: every pair checked below has one of them
+    free_id = [u_id for u_id in profiles_dict if free_capacity(u_id) > 0]
+    history_dict = {}
+    for u_id, partners_id in load_history(free_id).items():
+        for u_id_2 in partners_id:
+            history_dict.setdefault(u_id, []).append(u_id_2)
+            history_dict.setdefault(u_id_2, []).append(u_id)
+
+    index = CompatibilityIndex(profiles_dict, history_dict)
+    free = index.mask_of(free_id)
+
+    def can_meet(u_id, u_id_2):
+        i, j = index.position[u_id], index.position[u_id_2]
+        return u_id_2 not in partners_of.get(u_id, []) and index.accepts(i, j) and index.accepts(j, i)
+
+    def find_free_partner(u_id, excluded_id):
+        i = index.position[u_id]
+        excluded = [index.position[u_id_2] for u_id_2 in itertools.chain(excluded_id, partners_of.get(u_id, [])) if u_id_2 in index.position]
+        candidates = [j for j in index.candidates(i, free, excluded) if index.accepts(j, i)]
+        if len(candidates) == 0:
+            return None
+        return index.participants_id[candidates[rng.randrange(len(candidates))]]
+
+    def book(u_id, u_id_2):
+        nonlocal free
+        add_meeting(u_id, u_id_2)
+        for p_id in (u_id, u_id_2):
+            if free_capacity(p_id) == 0:
+                free &= ~(1 << index.position[p_id])
+
+    for u_id in affected_id:
+        while free_capacity(u_id) > 0:
+            partner_id = find_free_partner(u_id, [])
+            if partner_id is None:
+                break
+            book(u_id, partner_id)
+
+    # everyone compatible is busy: rewiring one of their meetings to someone who is still free
+    t = index.position.get(telegram_id)
+    if free_capacity(telegram_id) > 0 and free & ~(1 << t) != 0:
+        busy = index.everyone & ~free
+        busy_id = [index.participants_id[j] for j in index.candidates(t, busy) if len(partners_of.get(index.participants_id[j], [])) > 0]
+        rng.shuffle(busy_id)
+
+        for u_id in busy_id:
+            if free_capacity(telegram_id) == 0:
+                break
+            if free_capacity(u_id) != 0 or not can_meet(telegram_id, u_id):
+                continue
+            for u_id_2 in sorted(partners_of[u_id]):
+                if u_id_2 == telegram_id or u_id_2 not in index.position:
+                    continue
+                partner_id = find_free_partner(u_id_2, [telegram_id, u_id])
+                if partner_id is None:
+                    continue
+                remove_meeting(u_id, u_id_2)
+                book(telegram_id, u_id)
+                book(u_id_2, partner_id)
+                break
+
+    return result()
 
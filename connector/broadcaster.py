@@ -1,79 +1,195 @@
-import time, datetime
+import datetime
+import threading
 
-from .models import Meeting, User
+from .models import Meeting, User, Broadcast, BroadcastDelivery
+from .db import split_for_query, MAX_QUERY_PARAMETERS
+from .throttling import fan_out
+from .vars import *
 from django.utils.timezone import make_aware
 
-from django.db.models import Q
+from django.db.models import Q, F
 
+import logging
+logger = logging.getLogger('connector.apps')
 
-def broadacst_meeting_details(cb, year, week):
-    participants_id = Meeting.get_participants_id(year=year, week=week)
 
-    if len(participants_id) > 0:
-        for p_id in participants_id:
-            participant_partners_id = set()
-
-            participant_meetings = Meeting.objects.filter(Q(user_a_telegram_id=p_id) | Q(user_b_telegram_id=p_id))
-
-            for m in participant_meetings:
-                if m.user_a_telegram_id != p_id:
-                    participant_partners_id.add(m.user_a_telegram_id)
-                if m.user_b_telegram_id != p_id:
-                    participant_partners_id.add(m.user_b_telegram_id)
+# two lists of ids per UPDATE
+STAMP_CHUNK_SIZE = MAX_QUERY_PARAMETERS // 2
+
+
+# delivery state of every recipient, recipient is claimed before sending, so nobody gets the message twice
+class DeliveryStatus:
+    def __init__(self, broadcast, chunk_size=STAMP_CHUNK_SIZE):
+        self.broadcast = broadcast
+        self.chunk_size = chunk_size
+
+        self.deliveries_id = dict(broadcast.deliveries.values_list('user_telegram_id', 'id'))
+        self.delivered = {}
+        self.failed = {}
+        self._claimed = set()
+        self._unstamped = []
+        self._lock = threading.Lock()
+
+    def update(self, p_id, **kwargs):
+        return BroadcastDelivery.objects.filter(id=self.deliveries_id[p_id], **kwargs.pop('only_if', {})) \
+            .update(updated_at=make_aware(datetime.datetime.now()), **kwargs)
+
+    # False if the recipient was already handled by this or another run
+    def claim(self, p_id):
+        with self._lock:
+            retry = p_id in self._claimed
+            self._claimed.add(p_id)
+
+        if retry:
+            self.update(p_id, attempts=F('attempts') + 1)
+            return True
+
+        return self.update(p_id, only_if={'status': PENDING}, status=RETRYING, attempts=F('attempts') + 1) == 1
+
+    def mark_delivered(self, p_id):
+        now = make_aware(datetime.datetime.now())
+        self.update(p_id, status=SENT, sent_at=now, error='')
+
+        with self._lock:
+            self.delivered[p_id] = now
+            self.failed.pop(p_id, None)
+            self._unstamped.append(p_id)
+            if len(self._unstamped) < self.chunk_size:
+                return
+            participants_id, self._unstamped = self._unstamped, []
+        self.stamp(participants_id)
+
+    def mark_failed(self, p_id, error):
+        self.update(p_id, status=FAILED, error=str(error)[:500])
+
+        with self._lock:
+            self.failed[p_id] = error
+
+    def stamp(self, participants_id):
+        for chunk in split_for_query(participants_id, parameters_per_item=2):
+            Meeting.objects.filter(year=self.broadcast.year, week=self.broadcast.week) \
+                .filter(Q(user_a_telegram_id__in=chunk) | Q(user_b_telegram_id__in=chunk)) \
+                .update(broadcasted_at=make_aware(datetime.datetime.now()))
+
+    def flush(self):
+        with self._lock:
+            participants_id, self._unstamped = self._unstamped, []
+        if len(participants_id) > 0:
+            self.stamp(participants_id)
+
+
+# meetings of the week with participants and groups in two queries: telegram_id -> User, telegram_id -> partners
+def load_partner_directory(year, week):
+    meetings = Meeting.objects.filter(year=year, week=week).order_by('id')
+
+    partners_dict = {}
+    for u_id, u_id_2 in meetings.values_list('user_a_telegram_id', 'user_b_telegram_id'):
+        partners_dict.setdefault(u_id, [])
+        partners_dict.setdefault(u_id_2, [])
+        if u_id_2 not in partners_dict[u_id]:
+            partners_dict[u_id].append(u_id_2)
+        if u_id not in partners_dict[u_id_2]:
+            partners_dict[u_id_2].append(u_id)
+
+    # subqueries instead of long lists of ids, sqlite limits number of query parameters
+    users = User.objects.select_related('group').filter(
+        Q(telegram_id__in=meetings.values('user_a_telegram_id')) | Q(telegram_id__in=meetings.values('user_b_telegram_id'))
+    )
+    users_dict = {u.telegram_id: u for u in users}
+
+    return users_dict, partners_dict
+
+
+def render_meeting_details(p, partners):
+    total_partners = len(partners)
+
+    message = "Привет, {user_name}!\n\n".format(user_name=p.first_name) + \
+              "Идет новая неделя Random Coffee!\n\n" + \
+              "Мы запланировали тебе {meetings_counter} на этой неделе:\n\n" \
+                  .format(
+                  meetings_counter="%d %s" % (total_partners,
+                                              "встречу" if total_partners == 1 else
+                                              "встречи" if total_partners < 5 else "встреч")
+              )
+
+    for pp in partners:
+        he_or_she = 'он' if pp.gender == 'M' else 'она'
+        his_or_her = 'его' if pp.gender == 'M' else 'её'
+        him_or_her = 'ним' if pp.gender == 'M' else 'ней'
+        ending_verb = '' if pp.gender == 'M' else 'а'
+
+        message += "{partner_name}\n{phone_number}\n{job}\n{about}\n" \
+            .format(
+            partner_name="<i>%s</i>" % (pp.full_name),
+            phone_number="%s номер телефона: <b>%s</b>" % (his_or_her.capitalize(), pp.phone_number),
+            job='В коворкинге %s работает без коллег' % (he_or_she) if pp.group_name == '' else
+            'В коворкинге %s работает в компании: <i>%s</i>' % (he_or_she, pp.group_name),
+            about='Вот что %s пишет о себе: <i>%s</i>\n' % (he_or_she, pp.about) if pp.about != '' else
+            'К сожалению, %s ничего о себе не написал%s\n' % (he_or_she, ending_verb)
+        )
+
+    message += 'Спишись с {him_or_her} поскорее, пока неделя еще не расписана.\n\nУдачи!' \
+        .format(
+        him_or_her=him_or_her if total_partners == 1 else "ними"
+    )
+
+    return message
+
+
+# sends meeting details to everyone who hasn't got them yet, safe to call again after a crash
+def broadacst_meeting_details(cb, year, week, retry_failed=False):
+    if not Broadcast.objects.filter(year=year, week=week).exists() and \
+            Meeting.objects.filter(year=year, week=week, broadcasted_at__isnull=False).exists():
+        print("Meeting details were broadcasted before broadcasts were tracked: year=%d, week=%d" % (year, week))
+        return
+
+    users_dict, partners_dict = load_partner_directory(year, week)
+
+    if len(partners_dict) == 0:
+        print("No meetings are scheduled for this week: year=%d, week=%d" % (year, week))
+        return
 
-            participant_partners_id = list(participant_partners_id)
-            total_partners = len(participant_partners_id)
+    broadcast = Broadcast.get_or_create_for_week(year=year, week=week)
 
-            p = User.objects.get(telegram_id=p_id)
+    now = make_aware(datetime.datetime.now())
+    if retry_failed:
+        broadcast.deliveries.filter(status=FAILED).update(status=PENDING, updated_at=now)
+    elif broadcast.is_finished:
+        return
 
-            message = "Привет, {user_name}!\n\n".format(user_name=p.first_name) + \
-                      "Идет новая неделя Random Coffee!\n\n" + \
-                      "Мы запланировали тебе {meetings_counter} на этой неделе:\n\n" \
-                          .format(
-                          meetings_counter="%d %s" % (total_partners,
-                                                      "встречу" if total_partners == 1 else
-                                                      "встречи" if total_partners < 5 else "встреч")
-                      )
+    # message might have been sent right before the previous run was interrupted, it's never sent twice
+    interrupted = broadcast.deliveries.filter(status=RETRYING).update(status=FAILED, error='Interrupted, delivery is unknown', updated_at=now)
+    if interrupted > 0:
+        logger.error("%d deliveries were interrupted, they are marked as failed" % interrupted)
 
-            for pp_id in participant_partners_id:
-                pp = User.objects.get(telegram_id=pp_id)
+    participants_id = list(broadcast.deliveries.filter(status=PENDING).values_list('user_telegram_id', flat=True))
 
-                he_or_she = 'он' if pp.gender == 'M' else 'она'
-                his_or_her = 'его' if pp.gender == 'M' else 'её'
-                him_or_her = 'ним' if pp.gender == 'M' else 'ней'
-                ending_verb = '' if pp.gender == 'M' else 'а'
+    status = DeliveryStatus(broadcast)
 
-                message += "{partner_name}\n{phone_number}\n{job}\n{about}\n" \
-                    .format(
-                    partner_name="<i>%s</i>" % (pp.full_name),
-                    phone_number="%s номер телефона: <b>%s</b>" % (his_or_her.capitalize(), pp.phone_number),
-                    job='В коворкинге %s работает без коллег' % (he_or_she) if pp.group_name == '' else
-                    'В коворкинге %s работает в компании: <i>%s</i>' % (he_or_she, pp.group_name),
-                    about='Вот что %s пишет о себе: <i>%s</i>\n' % (he_or_she, pp.about) if pp.about != '' else
-                    'К сожалению, %s ничего о себе не написал%s\n' % (he_or_she, ending_verb)
-                )
+    def send_meeting_details(p_id):
+        p = users_dict[p_id]
+        message = render_meeting_details(p, [users_dict[pp_id] for pp_id in partners_dict[p_id]])
 
-            message += 'Спишись с {him_or_her} поскорее, пока неделя еще не расписана.\n\nУдачи!' \
-                .format(
-                him_or_her=him_or_her if total_partners == 1 else "ними"
-            )
+        if not status.claim(p_id):
+            return
 
-            dialog = cb.get_dialog(user=p)
+        dialog = cb.get_dialog(user=p)
 
-            now = make_aware(datetime.datetime.now())
+        message = dialog.send_message(text=message)
 
-            message = dialog.send_message(text=message)
+        status.mark_delivered(p_id)
 
-            for m in Meeting.objects.filter(user_a_telegram_id=p_id):
-                m.broadcasted_at = now
-                m.save()
+    # messages are sent concurrently within Telegram rate limits
+    failed = fan_out(participants_id, send_meeting_details, chat_id=lambda p_id: p_id)
+    for p_id, e in failed.items():
+        status.mark_failed(p_id, e)
+    status.flush()
 
-            for m in Meeting.objects.filter(user_b_telegram_id=p_id):
-                m.broadcasted_at = now
-                m.save()
+    if not broadcast.deliveries.filter(status__in=[PENDING, RETRYING]).exists():
+        broadcast.finished_at = make_aware(datetime.datetime.now())
+        broadcast.save()
 
-            time.sleep(2)
-    else:
-        print("No meetings are scheduled for this week: year=%d, week=%d" % (year, week))
+    if len(status.failed) > 0:
+        logger.error("Meeting details were not delivered to %d participants: %s" % (len(status.failed), ', '.join(status.failed.keys())))
 
     return
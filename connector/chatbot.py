@@ -6,8 +6,9 @@ from django.utils.timezone import make_aware
 import telegram
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler,  Filters
 
-from .models import User, UserState, Invitation, Meeting, Message
+from .models import User, UserState, Invitation, Meeting
 from .clock import Clock
+from .audit import AuditLog
 from .vars import *
 
 from django.db.models import Q
@@ -17,23 +18,74 @@ from django.core.exceptions import ObjectDoesNotExist
 import logging
 logger = logging.getLogger('connector.apps')
 
-from dictdiffer import diff
+from django.conf import settings
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
 import datetime
 
+# dialogs by chat_id, the least recently used are evicted, unused ones expire after ttl seconds
+class DialogCache:
+    def __init__(self, max_size=None, ttl=None):
+        if max_size is None:
+            max_size = settings.RANDOM_COFFEE_PLATFORM.get('DIALOG_CACHE_SIZE', 1000)
+        if ttl is None:
+            ttl = settings.RANDOM_COFFEE_PLATFORM.get('DIALOG_CACHE_TTL', 24 * 60 * 60)
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._dialogs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._dialogs)
+
+    def get(self, chat_id):
+        with self._lock:
+            item = self._dialogs.get(chat_id)
+            if item is None:
+                return None
+
+            dialog, used_at = item
+            if time.monotonic() - used_at > self.ttl:
+                del self._dialogs[chat_id]
+                return None
+
+            self._dialogs[chat_id] = (dialog, time.monotonic())
+            self._dialogs.move_to_end(chat_id)
+            return dialog
+
+    # returns dialog which ended up in cache, it may be added by another thread in the meantime
+    def add(self, dialog):
+        with self._lock:
+            item = self._dialogs.get(dialog.chat_id)
+            if item is not None:
+                dialog = item[0]
+
+            self._dialogs[dialog.chat_id] = (dialog, time.monotonic())
+            self._dialogs.move_to_end(dialog.chat_id)
+
+            while len(self._dialogs) > self.max_size:
+                self._dialogs.popitem(last=False)
+            return dialog
+
+
 class Chatbot:
     token = None
     community_name = ''
     request_kwargs = None
     updater = None
 
-    dialogs = []
+    dialogs = None
 
     def __init__(self, community_name, token, request_kwargs=None):
         self.community_name = community_name
         self.token = token
         self.request_kwargs = request_kwargs
         self.updater = Updater(token=self.token, request_kwargs=self.request_kwargs)
+        self.dialogs = DialogCache()
 
     @property
     def bot(self):
@@ -55,25 +107,32 @@ class Chatbot:
         self.dispatcher.add_handler(MessageHandler(Filters.text | Filters.contact, self.general_message_handler))
         self.dispatcher.add_handler(CallbackQueryHandler(self.callback_query_handler))
 
-    def get_dialog(self, user: User) -> Dialog:
+    def get_dialog(self, user: User, user_state: UserState = None) -> Dialog:
         logger.info("DIALOG LOOKUP IN CACHE")
-        dialog_list = list(filter(lambda x: x.chat_id == user.telegram_id, self.dialogs))
+        dialog = self.dialogs.get(user.telegram_id)
 
-        if len(dialog_list) == 0:
+        if dialog is None:
             logger.info("dialog NOT FOUND")
             logger.info("initializing dialog")
             # TODO refactor to avoid calling globals
-            dialog = Dialog(community_name=self.community_name, bot=self.bot, user=user)
+            dialog = self.dialogs.add(Dialog(community_name=self.community_name, bot=self.bot, user=user, user_state=user_state))
             dialog.user.check_in()
-            self.dialogs.append(dialog)
             logger.info("---")
             return dialog
-        elif len(dialog_list) == 1:
-            logger.info("dialog FOUND")
-            dialog_list[0].user.check_in()
-            return dialog_list[0]
         else:
-            raise Exception('Too many dialogs with same user in cache')
+            logger.info("dialog FOUND")
+            # caller's user is at least as fresh as the cached one
+            with dialog.lock:
+                dialog.user = user
+            dialog.user.check_in()
+            return dialog
+
+    # user with their state is loaded in one query per update and the state is written once when the update is handled
+    # usage: with cb.open_dialog(telegram_id) as dialog: ...
+    def open_dialog(self, telegram_id):
+        user_state = UserState.objects.select_related('user', 'user__group').get(user__telegram_id=telegram_id)
+        dialog = self.get_dialog(user=user_state.user, user_state=user_state)
+        return dialog.unit_of_work(user_state)
 
 
     @staticmethod
@@ -101,7 +160,7 @@ class Chatbot:
             dialog = self.get_dialog(user=user)
 
             status_text = "<b>User Telegram ID:</b> %s \n" % (user.telegram_id) + \
-            "<b>User state, level 1 (database):</b> %s \n" % (user.state_context_saved) + \
+            "<b>User state, level 1 (database):</b> %s \n" % (UserState.objects.get(user=user).context) + \
             "<b>Dialog state, level 1 (bot cache):</b> %s \n" % (dialog._state.context)
             bot.send_message(
                 chat_id=update.message.chat_id,
@@ -135,12 +194,11 @@ class Chatbot:
             dialog = self.get_dialog(user=new_user_from_db)
             dialog.transition_to(WelcomeNewUserState())
         else:
-            dialog = self.get_dialog(user=user)
-
-            if user.finished_registration:
-                dialog.transition_to(UserProfileState())
-            else:
-                dialog.transition_to(WelcomeExistingUserState())
+            with self.open_dialog(user.telegram_id) as dialog:
+                if dialog.user.finished_registration:
+                    dialog.transition_to(UserProfileState())
+                else:
+                    dialog.transition_to(WelcomeExistingUserState())
 
     def info_command_handler(self, bot, update):
         logger.info("info_command_handler")
@@ -157,12 +215,11 @@ class Chatbot:
     def feedback_command_handler(self, bot, update):
         logger.info("feedback_command_handler")
         try:
-            user = User.objects.get(telegram_id=update.effective_user.id)
-            dialog = self.get_dialog(user=user)
-            dialog.transition_to(AskFeedbackState())
+            with self.open_dialog(update.effective_user.id) as dialog:
+                dialog.transition_to(AskFeedbackState())
         except ObjectDoesNotExist:
-            user = None
             # TODO: decide what to do if user not found
+            pass
 
     def general_message_handler(self, bot, update):
         logger.info("")
@@ -170,100 +227,119 @@ class Chatbot:
         logger.info(update.message.text)
         logger.info("general_message_handler")
         try:
-            user = User.objects.get(telegram_id=update.effective_user.id)
-            dialog = self.get_dialog(user)
-            dialog.reply_to_message(update)
+            with self.open_dialog(update.effective_user.id) as dialog:
+                dialog.reply_to_message(update)
         except ObjectDoesNotExist:
-            user = None
             # TODO: decide what to do if user not found
+            pass
 
     def callback_query_handler(self, bot, update):
         logger.info("callback_query_handler")
         try:
-            user = User.objects.get(telegram_id=update.effective_user.id)
-            dialog = self.get_dialog(user)
-            dialog.reply_to_callback_query(update)
+            with self.open_dialog(update.effective_user.id) as dialog:
+                dialog.reply_to_callback_query(update)
         except ObjectDoesNotExist:
-            user = None
             # TODO: decide what to do if user not found
+            pass
 
 
 class Dialog:
     bot = None
     user = None
     _state = None
+    state_version = None
+
+    _user_state = None
+    _context_changed = False
 
     @property
     def chat_id(self):
         return self.user.telegram_id
 
-    def __init__(self, community_name, bot: Chatbot, user: User) -> None:
+    def __init__(self, community_name, bot: Chatbot, user: User, user_state: UserState = None) -> None:
         self.community_name = community_name
         self.bot = bot
         self.user = user
+        # dialog is shared by dispatcher, web views and management commands,
+        # their transitions wait until the update being handled is written
+        self.lock = threading.RLock()
+
+        self.restore_dialog_state(user_state=user_state)
+
+    # changes of dialog state while handling one update are written once, when the update is handled
+    @contextmanager
+    def unit_of_work(self, user_state: UserState):
+        with self.lock:
+            self.user = user_state.user
+            self._user_state = user_state
+            try:
+                yield self
+            finally:
+                self._user_state = None
+                if self._context_changed:
+                    self.write_context()
+
+    def save_context(self):
+        if self._user_state is not None:
+            self._context_changed = True
+        else:
+            self.write_context()
 
-        self.restore_dialog_state()
+    def write_context(self):
+        self._context_changed = False
+        if UserState.write_context(self.user, self._state.context):
+            # version in db is unknown if the dialog never read it, next restore will read it
+            if self.state_version is not None:
+                self.state_version += 1
 
     # db state is master no matter what
-    def restore_dialog_state(self):
+    def restore_dialog_state(self, user_state: UserState = None):
         logger.info("CHECKING STATE BEFORE RESTORE SAVE")
 
-        user_state_in_db = None
-        try:
-            user_state_in_db = UserState.objects.get(user=self.user)
-        except ObjectDoesNotExist:
-            pass
+        if user_state is None:
+            user_state = self._user_state
+
+        if user_state is not None:
+            user_state_in_db = (user_state.version, user_state.context)
+        else:
+            user_state_in_db = UserState.objects.filter(user=self.user).values_list('version', 'context').first()
 
         logger.info("restoring state")
         if user_state_in_db is not None:
-            # re-querying user object to fetch updated state_saved in db
-            # turns out this self.user stores copy of instance, not list to it's representation in db
-            # state is stored in db as dict. example:
-            # { 'state_name': 'Example State', 'params': { 'p1': 1, 'p2': 2 } }
-            from ast import literal_eval
-            db_context = literal_eval(user_state_in_db.context)
-            logger.info('db state: %s' % str(db_context))
-
-            if db_context['state_name'] in globals().keys():
-                user_state_restored_from_db = globals()[db_context['state_name']](params=db_context['params'])
-            else:
-                # almost impossible case if non-existent state is recorded in database
-                user_state_restored_from_db = ErrorState()
+            version, context = user_state_in_db
 
-            if self._state is None:
-                logger.info("cache state is undefined, transitioning to db state")
-                self.transition_to(user_state_restored_from_db, silent_enter=True)
-            else:
-                logger.info("cache state is cached")
+            logger.info("comparing state versions in cache and db")
+            if self._state is not None and self.state_version == version:
+                logger.info("db state equals cache state, aborting transition")
+                return
 
-                cached_context = self._state.context
+            db_context = UserState.decode_context(context)
+            logger.info('db state: %s' % str(db_context))
 
-                logger.info("comparing state versions in cache and db")
-                logger.info("cache state name: %s" % cached_context['state_name'])
-                logger.info("db state name: %s" % db_context['state_name'])
+            user_state_restored_from_db = DialogState.from_context(db_context)
 
-                if len(list(diff(cached_context, db_context))) > 0:
-                    logger.info("db state is different, transitioning to db state")
-                    self.transition_to(user_state_restored_from_db, silent_enter=True)
-                else:
-                    logger.info("db state equals cache state, aborting transition")
+            logger.info("db state is different, transitioning to db state")
+            self.state_version = version
+            self.transition_to(user_state_restored_from_db, silent_enter=True, save=False)
         else:
             logger.info("user state in dialog is not initialized in db, aborting transition")
 
-    def transition_to(self, state: DialogState, silent_enter=False):
-        logger.info("TRANSITION TO %s" % state.context['state_name'])
-        if not (self._state is None):
-            self.send_farewell_message(silent_enter=silent_enter)
+    # save=False is used when state comes from db and there is nothing to write
+    def transition_to(self, state: DialogState, silent_enter=False, save=True):
+        with self.lock:
+            logger.info("TRANSITION TO %s" % state.context['state_name'])
+            if not (self._state is None):
+                self.send_farewell_message(silent_enter=silent_enter)
 
-        logger.info("SETTING STATE")
-        self._state = state
-        self._state.dialog = self
-        self._state.dialog.user = User.objects.get(telegram_id=self._state.dialog.user.telegram_id)
-        self._state.update_context()
+            logger.info("SETTING STATE")
+            self._state = state
+            self._state.dialog = self
+            if save:
+                self._state.update_context()
 
-        logger.info("TRANSITION FINISHED")
-        logger.info("sending welcome message from new state")
-        self.send_welcome_message(silent_enter=silent_enter)
+            logger.info("TRANSITION FINISHED")
+            logger.info("sending welcome message from new state")
+            self.send_welcome_message(silent_enter=silent_enter)
 
     def send_message(self, text, reply_markup=None, parse_mode=None, chat_id=None, one_time_keyboard=None):
         if reply_markup is None:
@@ -286,18 +362,14 @@ class Dialog:
             one_time_keyboard=one_time_keyboard
         )
 
-        # naive logging
+        # naive logging, written in background
         #TODO: log reply_markup
-        try:
-            Message(
-                user=self.user,
-                direction="out",
-                text=str(text),
-                message_id=m.message_id
-            ).save()
-        except Exception as e:
-            logger.error(e)
-            print(e)
+        AuditLog.record(
+            user=self.user,
+            direction="out",
+            text=str(text),
+            message_id=m.message_id
+        )
 
         return m
 
@@ -313,17 +385,13 @@ class Dialog:
         self._state.handle_callback_query(update)
 
     def reply_to_message(self, update):
-        # naive logging
-        try:
-            Message(
-                user=self.user,
-                direction="in",
-                text=str(update.message.text),
-                message_id=update.message.message_id
-            ).save()
-        except Exception as e:
-            logger.error(e)
-            print(e)
+        # naive logging, written in background
+        AuditLog.record(
+            user=self.user,
+            direction="in",
+            text=str(update.message.text),
+            message_id=update.message.message_id
+        )
         logger.info("CALLING reply_to_message")
         self.restore_dialog_state()
         self._state.handle_message(update)
@@ -349,6 +417,14 @@ class DialogState(ABC):
     _context = None
     _dialog = None
 
+    # state name -> state class, every subclass is registered when it's defined
+    registry = {}
+    default_params = {'stop_after_finish': False}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        DialogState.registry[cls.__name__] = cls
+
     def __init__(self, params={}):
         context_dict = dict({'state_name': type(self).__name__})
         context_dict['params'] = params
@@ -356,11 +432,19 @@ class DialogState(ABC):
 
     @classmethod
     def set_default_params(cls, context_dict):
-        logger.info(context_dict['params'])
-        if not 'stop_after_finish' in context_dict['params'].keys():
-            context_dict['params']['stop_after_finish'] = False
+        for key, value in cls.default_params.items():
+            if not key in context_dict['params']:
+                context_dict['params'][key] = value
         return context_dict
 
+    # only registered states can be restored from database, anything else ends up in ErrorState
+    @classmethod
+    def from_context(cls, context_dict):
+        state_class = DialogState.registry.get(context_dict.get('state_name'))
+        if state_class is None:
+            return ErrorState()
+        return state_class(params=context_dict.get('params', {}))
+
     @property
     def context(self) -> dict:
         return self._context
@@ -370,16 +454,11 @@ class DialogState(ABC):
         self._context = context
 
     def update_context_stage(self, stage=0):
-        user_state = UserState.objects.get(user=self.dialog.user)
         self.context['params']['stage'] = stage
-        user_state.context = str(self.context)
-        user_state.save()
+        self.update_context()
 
     def update_context(self):
-        user_state = UserState.objects.get(user=self.dialog.user)
-        user_state.context = str(self.context)
-        user_state.context = str(self.context)
-        user_state.save()
+        self.dialog.save_context()
 
     @property
     def dialog(self) -> Dialog:
@@ -616,6 +695,9 @@ class ReplyToMeetingInvitationState(DialogState):
                     inv.counter += 1
 
                     inv.save()
+            except (telegram.error.RetryAfter, telegram.error.NetworkError):
+                # sender retries these within rate limits
+                raise
             except Exception as e:
                 print(e)
                 logger.info(e)
@@ -671,8 +753,7 @@ class ReplyToMeetingInvitationState(DialogState):
                     self.update_context_stage(self.__AWAITING_CANCELLATION_FEEDBACK)
                     self.handle_entering_state()
 
-                new_meeting_schedule = inv.trigger_rearrange_meetings()
-                logger.info(new_meeting_schedule)
+                inv.trigger_rearrange_meetings()
 
                 return
 
@@ -0,0 +1,42 @@
+import functools
+
+from django.db import connection
+
+# sqlite limits number of query parameters to 999, the rest is left for other conditions of the query
+MAX_QUERY_PARAMETERS = 900
+
+
+# lists of items small enough to be passed to one query, when every item takes parameters_per_item parameters
+def split_for_query(items, parameters_per_item=1):
+    items = list(items)
+    chunk_size = max(1, MAX_QUERY_PARAMETERS // parameters_per_item)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+# every chunk is a separate query ordered by pk, so no cursor stays open while workers write to sqlite
+def iterate_in_chunks(queryset, chunk_size=500):
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+
+        for obj in chunk:
+            yield obj
+
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+# worker thread gets its own db connection, it must not leak
+def closes_connection(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connection.close()
+    return wrapper
@@ -0,0 +1,100 @@
+import datetime
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from connector.clock import Clock
+from connector.models import Message, MessageArchive
+from connector.db import iterate_in_chunks, split_for_query
+
+
+class Command(BaseCommand):
+    help = "Move messages older than retention period into gzipped archive files, one file per ISO week"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-weeks', '-r', type=int, help="How many recent weeks of messages stay in the database", default=None)
+        parser.add_argument('--dir', '-d', help="Directory for archive files", default=None)
+        parser.add_argument('--dry-run', action='store_true', help="Only show which weeks would be archived")
+        parser.add_argument('--vacuum', action='store_true', help="Compact sqlite database file after archiving")
+
+    @staticmethod
+    def serialize(m):
+        return json.dumps({
+            'id': m.id,
+            'user_id': m.user_id,
+            'telegram_id': m.user.telegram_id,
+            'direction': m.direction,
+            'text': m.text,
+            'message_id': m.message_id,
+            'sent_at': m.sent_at.isoformat()
+        }, ensure_ascii=False)
+
+    def archive_week(self, year, week, archive_dir):
+        file_path = os.path.join(archive_dir, 'messages_%d_w%02d.jsonl.gz' % (year, week))
+        tmp_path = file_path + '.tmp'
+
+        # archive is rewritten in a temporary file and replaced at once, so an interrupted run never leaves
+        # a half written file, and messages already in the file are skipped when the run is repeated
+        file_id = set()
+        archived_id = []
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            if os.path.exists(file_path):
+                with gzip.open(file_path, 'rt', encoding='utf-8') as old:
+                    for line in old:
+                        file_id.add(json.loads(line)['id'])
+                        f.write(line)
+
+            for m in iterate_in_chunks(Message.objects.filter(year=year, week=week).select_related('user'), chunk_size=1000):
+                if m.id not in file_id:
+                    f.write(self.serialize(m) + '\n')
+                    file_id.add(m.id)
+                archived_id.append(m.id)
+        os.replace(tmp_path, file_path)
+
+        with transaction.atomic():
+            archive, created = MessageArchive.objects.get_or_create(year=year, week=week, defaults={'file_path': file_path})
+            archive.file_path = file_path
+            archive.messages_count = len(file_id)
+            archive.size_bytes = os.path.getsize(file_path)
+            archive.save()
+
+            for chunk in split_for_query(archived_id):
+                Message.objects.filter(id__in=chunk).delete()
+
+        return len(archived_id)
+
+    def handle(self, *args, **options):
+        retention_weeks = options.get('retention_weeks')
+        if retention_weeks is None:
+            retention_weeks = settings.RANDOM_COFFEE_PLATFORM.get('MESSAGE_RETENTION_WEEKS', 12)
+
+        archive_dir = options.get('dir')
+        if archive_dir is None:
+            archive_dir = settings.RANDOM_COFFEE_PLATFORM.get('MESSAGE_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive'))
+
+        year, week = Clock.get_current_iso_week()
+        cutoff = Clock.get_monday_same_week_by_year_and_week(year, week) - datetime.timedelta(weeks=retention_weeks)
+        cutoff_year, cutoff_week = Clock.get_iso_week(cutoff)
+
+        weeks = Message.objects.filter(Q(year__lt=cutoff_year) | Q(year=cutoff_year, week__lt=cutoff_week)) \
+            .values_list('year', 'week').distinct().order_by('year', 'week')
+
+        if options.get('dry_run'):
+            for year, week in weeks:
+                self.stdout.write("w%dy%d: %d messages" % (week, year, Message.objects.filter(year=year, week=week).count()))
+            return
+
+        os.makedirs(archive_dir, exist_ok=True)
+
+        for year, week in list(weeks):
+            messages_count = self.archive_week(year, week, archive_dir)
+            self.stdout.write("w%dy%d: %d messages archived" % (week, year, messages_count))
+
+        if options.get('vacuum') and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
@@ -0,0 +1,96 @@
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from connector.blender import match_participants, count_unsatisfied, SOLVERS, COMPATIBILITY_MODES
+from connector.vars import *
+
+
+class Command(BaseCommand):
+    help = "Benchmark matching solvers on synthetic communities (no database is used)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', '-n', help="Comma-separated community sizes", default='1000,2000,5000')
+        parser.add_argument('--solvers', '-s', help="Comma-separated solvers", default=','.join(SOLVERS.keys()))
+        parser.add_argument('--compatibility', '-c', help="Compatibility mode: %s" % ', '.join(COMPATIBILITY_MODES), default='python')
+        parser.add_argument('--history', type=int, help="Average number of past meetings per user", default=10)
+        parser.add_argument('--seed', type=int, help="Seed for community generation and matching", default=0)
+
+    @staticmethod
+    def generate_community(size, history, rng):
+        # roughly half of people come alone, the rest work in companies of very different size
+        companies = ['Company %d' % i for i in range(0, max(1, size // 20))]
+        companies_weights = [1.0 / (i + 1) for i in range(0, len(companies))]
+        groups = [''] + companies
+        groups_weights = [sum(companies_weights)] + companies_weights
+
+        participants_id = [str(100000 + i) for i in range(0, size)]
+
+        profiles_dict = {}
+        for p_id in participants_id:
+            profiles_dict[p_id] = {
+                'group_name': rng.choices(groups, weights=groups_weights)[0],
+                'gender': rng.choice([MALE, FEMALE]),
+                'frequency': rng.choices([HIGH, MEDIUM, LOW], weights=[25, 50, 25])[0],
+                'motivation': rng.choices([DATING, NETWORKING, HAVING_FUN], weights=[15, 45, 40])[0]
+            }
+
+        history_dict = {p_id: set() for p_id in participants_id}
+        for i in range(0, size * history // 2):
+            u_id, u_id_2 = rng.sample(participants_id, 2)
+            history_dict[u_id].add(u_id_2)
+            history_dict[u_id_2].add(u_id)
+        history_dict = {p_id: list(partners_id) for p_id, partners_id in history_dict.items()}
+
+        # half of low frequency users had a meeting last week
+        capacity_dict = {}
+        for p_id in participants_id:
+            if profiles_dict[p_id]['frequency'] == HIGH:
+                capacity_dict[p_id] = 2
+            elif profiles_dict[p_id]['frequency'] == LOW:
+                capacity_dict[p_id] = rng.choice([0, 1])
+            else:
+                capacity_dict[p_id] = 1
+
+        return profiles_dict, history_dict, capacity_dict
+
+    def handle(self, *args, **options):
+        sizes = [int(n) for n in options.get('sizes').split(',')]
+        solvers = options.get('solvers').split(',')
+        compatibility = options.get('compatibility')
+        seed = options.get('seed')
+
+        for solver in solvers:
+            if solver not in SOLVERS:
+                self.stderr.write("Unknown solver: %s" % solver)
+                return
+        if compatibility not in COMPATIBILITY_MODES:
+            self.stderr.write("Unknown compatibility mode: %s" % compatibility)
+            return
+
+        self.stdout.write("%8s %14s %10s %12s %10s %10s %12s %20s" %
+                          ('size', 'solver', 'time, s', 'memory, MB', 'meetings', 'max', 'left alone', 'left underutilized'))
+
+        for size in sizes:
+            profiles_dict, history_dict, capacity_dict = self.generate_community(size, options.get('history'), random.Random(seed))
+            upper_bound = sum(capacity_dict.values()) // 2
+
+            for solver in solvers:
+                tracemalloc.start()
+                started_at = time.perf_counter()
+
+                compatibility_index, meetings = match_participants(
+                    profiles_dict, history_dict, capacity_dict,
+                    compatibility=compatibility, solver=solver, rng=random.Random(seed)
+                )
+
+                wall_time = time.perf_counter() - started_at
+                memory_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                left_alone, left_underutilized = count_unsatisfied(meetings, capacity_dict)
+
+                self.stdout.write("%8d %14s %10.2f %12.1f %10d %10d %12d %20d" %
+                                  (size, solver, wall_time, memory_peak / 1024 / 1024, len(meetings), upper_bound, left_alone, left_underutilized))
@@ -1,10 +1,10 @@
-import time
-
 from django.core.management.base import BaseCommand
 
 from connector.apps import ChatbotConnector
+from connector.broadcaster import load_partner_directory
 from connector.chatbot import *
-from connector.models import User, Meeting
+from connector.models import Meeting
+from connector.throttling import fan_out
 
 
 class Command(BaseCommand):
@@ -30,23 +30,24 @@ class Command(BaseCommand):
             year = options.get('year')
             week = options.get('week')
 
-        participants_id = Meeting.get_participants_id(year=year, week=week)
+        users_dict, partners_dict = load_partner_directory(year=year, week=week)
 
-        if len(participants_id) > 0:
-            for p_id in participants_id:
-                m = Meeting.objects.filter(Q(user_a_telegram_id=p_id) | Q(user_b_telegram_id=p_id))[0]
-                m.reset_user_feedback(user_telegram_id=p_id)
+        if len(partners_dict) > 0:
+            Meeting.reset_feedback(year=year, week=week)
 
-                dialog = cb.get_dialog(user=User.objects.get(telegram_id=p_id))
+            # survey starts from the first partner, the rest of the week's meetings are asked about one by one
+            def send_survey(p_id):
+                dialog = cb.get_dialog(user=users_dict[p_id])
 
                 dialog.transition_to(CollectMeetingFeedbackState(params={
-                    "partner_id": m.get_partner_id(p_id),
+                    "partner_id": partners_dict[p_id][0],
                     "year": year,
                     "week": week
                 }))
 
-                time.sleep(2)
+            # surveys are sent concurrently within Telegram rate limits
+            failed = fan_out(partners_dict.keys(), send_survey, chat_id=lambda p_id: p_id)
+            if len(failed) > 0:
+                self.stderr.write("Surveys were not sent to %d participants: %s" % (len(failed), ', '.join(failed.keys())))
         else:
             print("No meetings are scheduled for this week: year=%d, week=%d" % (year, week))
-
-
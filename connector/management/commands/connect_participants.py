@@ -2,7 +2,6 @@ from django.core.management.base import BaseCommand
 
 from connector.apps import ChatbotConnector
 from connector.clock import Clock
-from connector.models import Meeting
 
 from connector.broadcaster import broadacst_meeting_details
 
@@ -16,6 +15,8 @@ class Command(BaseCommand):
         parser.add_argument('--year', '-y', type=int, help="Year of meeting week (ISO calendar)", default=None)
         parser.add_argument('--week', '-w', type=int, help="Week number of meeting week (ISO calendar)", default=None)
 
+        parser.add_argument('--retry-failed', action='store_true', help="Resend meeting details to participants whose delivery failed")
+
     def handle(self, *args, **options):
         cb = ChatbotConnector.get_bot(options.get('token'), options.get('username'))
 
@@ -29,5 +30,5 @@ class Command(BaseCommand):
             year = options.get('year')
             week = options.get('week')
 
-        if not Meeting.were_details_broadcasted(year, week):
-            broadacst_meeting_details(cb, year, week)
+        # unfinished broadcast is resumed, those who already got meeting details are skipped
+        broadacst_meeting_details(cb, year, week, retry_failed=options.get('retry_failed'))
@@ -1,10 +1,11 @@
-import time
-
 from django.core.management.base import BaseCommand
 
 from connector.apps import ChatbotConnector
 from connector.chatbot import *
 from connector.models import User
+from connector.scheduler import RematchScheduler
+from connector.db import iterate_in_chunks
+from connector.throttling import fan_out
 
 
 class Command(BaseCommand):
@@ -25,7 +26,7 @@ class Command(BaseCommand):
             self.stderr.write("Bot not found")
             return
 
-        registered_users = [u for u in User.objects.all() if (u.finished_registration is True) and (u.enabled is True)]
+        registered_users = User.objects.filter(registered_at__isnull=False, enabled=True)
 
         if options.get('year') is None or options.get('week') is None:
             year, week = Clock.get_next_iso_week()
@@ -33,22 +34,28 @@ class Command(BaseCommand):
             year = options.get('year')
             week = options.get('week')
 
-        for u in registered_users:
-            try:
-                inv = Invitation.objects.get(
-                    user=u,
-                    year=year,
-                    week=week
-                )
-                inv.reset_decision()
-                inv.rearrange_meeetings()
-            except ObjectDoesNotExist:
-                pass
+        # users invited earlier this week get their decision reset, the rest get fresh invitations in bulk
+        invitations = Invitation.objects.filter(year=year, week=week)
+
+        decisions_reset = Invitation.reset_decisions(year=year, week=week, users=registered_users)
+
+        Invitation.objects.bulk_create([
+            Invitation(user_id=user_id, year=year, week=week)
+            for user_id in registered_users.exclude(id__in=invitations.values('user_id')).values_list('id', flat=True)
+        ], batch_size=500, ignore_conflicts=True)
 
+        # nobody has accepted anymore, meetings are rearranged once for the whole week
+        if decisions_reset > 0:
+            RematchScheduler.schedule(year=year, week=week)
+
+        def send_invitation(u):
             dialog = cb.get_dialog(user=u)
 
             dialog.transition_to(ReplyToMeetingInvitationState(params={"year": year, "week": week}))
 
-            time.sleep(2)
-
+        # invitations are sent concurrently within Telegram rate limits
+        failed = fan_out(iterate_in_chunks(registered_users.select_related('group')), send_invitation, chat_id=lambda u: u.telegram_id)
+        if len(failed) > 0:
+            self.stderr.write("Invitations were not sent to %d users: %s" % (len(failed), ', '.join([u.telegram_id for u in failed.keys()])))
 
+        RematchScheduler.flush()
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0019_auto_20191218_1903'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('week', models.IntegerField()),
+                ('year', models.IntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BroadcastDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_telegram_id', models.CharField(max_length=100)),
+                ('status', models.CharField(choices=[('P', 'Ожидает отправки'), ('S', 'Отправлено'), ('F', 'Не доставлено'), ('R', 'Отправляется')], default='P', max_length=1)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.CharField(blank=True, default='', max_length=500)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='connector.Broadcast')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='broadcast',
+            constraint=models.UniqueConstraint(fields=('week', 'year'), name='unique_broadcast'),
+        ),
+        migrations.AddConstraint(
+            model_name='broadcastdelivery',
+            constraint=models.UniqueConstraint(fields=('broadcast', 'user_telegram_id'), name='unique_broadcast_delivery'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:05
+
+import json
+from ast import literal_eval
+
+from django.db import migrations, models
+
+
+def context_to_json(apps, schema_editor):
+    UserState = apps.get_model('connector', 'UserState')
+    for user_state in UserState.objects.all():
+        try:
+            context = literal_eval(user_state.context)
+        except (ValueError, SyntaxError):
+            # context truncated by the old 500 chars limit can't be restored
+            context = {'state_name': 'NullState', 'params': {}}
+        user_state.context = json.dumps(context, ensure_ascii=False, separators=(',', ':'))
+        user_state.version = 1
+        user_state.save(update_fields=['context', 'version'])
+
+
+def context_to_dict_literal(apps, schema_editor):
+    UserState = apps.get_model('connector', 'UserState')
+    for user_state in UserState.objects.all():
+        user_state.context = str(json.loads(user_state.context))
+        user_state.save(update_fields=['context'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0020_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstate',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='userstate',
+            name='context',
+            field=models.TextField(default='{"state_name":"NullState","params":{}}'),
+        ),
+        migrations.RunPython(context_to_json, context_to_dict_literal),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:08
+
+from django.db import migrations, models
+import django.utils.timezone
+
+from connector.db import split_for_query
+
+
+def set_iso_week(apps, schema_editor):
+    Message = apps.get_model('connector', 'Message')
+
+    messages_id = {}
+    for message_id, sent_at in Message.objects.order_by('id').values_list('id', 'sent_at').iterator():
+        year, week = django.utils.timezone.localtime(sent_at).isocalendar()[:2]
+        messages_id.setdefault((year, week), []).append(message_id)
+
+    for (year, week), ids in messages_id.items():
+        for chunk in split_for_query(ids):
+            Message.objects.filter(id__in=chunk).update(year=year, week=week)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0021_user_state_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('week', models.IntegerField()),
+                ('year', models.IntegerField()),
+                ('file_path', models.CharField(max_length=500)),
+                ('messages_count', models.IntegerField(default=0)),
+                ('size_bytes', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='week',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='year',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_iso_week, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['year', 'week'], name='message_week_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sent_at'], name='message_sent_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', 'sent_at'], name='message_user_sent_at_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchive',
+            constraint=models.UniqueConstraint(fields=('week', 'year'), name='unique_message_archive'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.8 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0022_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['user_a_telegram_id'], name='meeting_user_a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='meeting',
+            index=models.Index(fields=['user_b_telegram_id'], name='meeting_user_b_idx'),
+        ),
+    ]
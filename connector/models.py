@@ -1,4 +1,7 @@
-from django.db import models
+import json
+
+from django.db import models, transaction
+from django.conf import settings
 import django.utils.timezone
 from .clock import Clock
 
@@ -65,20 +68,32 @@ class User(models.Model):
 
     @classmethod
     def statistics(cls):
+        # one aggregate over registered users instead of a query per number
+        counters = cls.objects.filter(registered_at__isnull=False).aggregate(
+            male=models.Count('id', filter=Q(gender=MALE)),
+            female=models.Count('id', filter=Q(gender=FEMALE)),
+            high=models.Count('id', filter=Q(meeting_frequency=HIGH)),
+            medium=models.Count('id', filter=Q(meeting_frequency=MEDIUM)),
+            low=models.Count('id', filter=Q(meeting_frequency=LOW)),
+            dating=models.Count('id', filter=Q(meeting_motivation=DATING)),
+            networking=models.Count('id', filter=Q(meeting_motivation=NETWORKING)),
+            fun=models.Count('id', filter=Q(meeting_motivation=HAVING_FUN))
+        )
+
         return {
             'gender': {
-                'male': cls.objects.filter(gender=MALE, registered_at__isnull=False).count(),
-                'female': cls.objects.filter(gender=FEMALE, registered_at__isnull=False).count()
+                'male': counters['male'],
+                'female': counters['female']
             },
             'frequency': {
-                'high': cls.objects.filter(meeting_frequency=HIGH, registered_at__isnull=False).count(),
-                'medium': cls.objects.filter(meeting_frequency=MEDIUM, registered_at__isnull=False).count(),
-                'low': cls.objects.filter(meeting_frequency=LOW, registered_at__isnull=False).count()
+                'high': counters['high'],
+                'medium': counters['medium'],
+                'low': counters['low']
             },
             'motivation': {
-                'dating': cls.objects.filter(meeting_motivation=DATING, registered_at__isnull=False).count(),
-                'networking': cls.objects.filter(meeting_motivation=NETWORKING, registered_at__isnull=False).count(),
-                'fun': cls.objects.filter(meeting_motivation=HAVING_FUN, registered_at__isnull=False).count()
+                'dating': counters['dating'],
+                'networking': counters['networking'],
+                'fun': counters['fun']
             }
         }
 
@@ -130,19 +145,19 @@ class User(models.Model):
 
         # true and false overhead because
         # django.core.exceptions.FieldError: Unsupported lookup 'is_null' for BooleanField or join on the field not permitted, perhaps you meant isnull?
-        mm = Meeting.objects.filter(
+        mm = Meeting.objects.filter(year=year, week=week).filter(
             (Q(user_a_telegram_id=self.telegram_id) & ~Q(user_a_meeting_took_place=True) & ~Q(user_a_meeting_took_place=False)) |
             (Q(user_b_telegram_id=self.telegram_id) & ~Q(user_b_meeting_took_place=True) & ~Q(user_b_meeting_took_place=False))
         )
 
-        if mm.count() > 0:
-            return mm[0]
-        else:
-            return
+        return mm.order_by('id').first()
 
+    # last_seen_at is written in background by ActivityTracker, not with the whole row
     def check_in(self):
+        from .activity import ActivityTracker
+
         self.last_seen_at = django.utils.timezone.now()
-        self.save()
+        ActivityTracker.touch(self.id, seen_at=self.last_seen_at)
 
     def save(self, *args, **kwargs):
         # _state is internal Django thing
@@ -161,13 +176,43 @@ class User(models.Model):
 
 class UserState(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=False, null=False)
-    context = models.CharField(max_length=500, default="{'state_name': 'NullState', 'params': {}}")
+    # context is stored as JSON. example:
+    # {"state_name": "Example State", "params": {"p1": 1, "p2": 2}}
+    context = models.TextField(default='{"state_name":"NullState","params":{}}')
+    # grows with every write of context, so cached state is checked without reading context itself
+    version = models.IntegerField(default=0)
     updated_at = models.DateTimeField(default=django.utils.timezone.now)
 
+    @staticmethod
+    def encode_context(context):
+        return json.dumps(context, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def decode_context(context):
+        return json.loads(context)
+
+    # one UPDATE, returns False if user has no state
+    @classmethod
+    def write_context(cls, user, context):
+        return cls.objects.filter(user=user).update(
+            context=cls.encode_context(context),
+            version=models.F('version') + 1,
+            updated_at=django.utils.timezone.now()
+        ) > 0
+
+    # every write changes version, so dialogs which cached the state read context again
     def save(self, *args, **kwargs):
         self.updated_at = django.utils.timezone.now()
 
-        return super(UserState, self).save(*args, **kwargs)
+        if self._state.adding:
+            return super(UserState, self).save(*args, **kwargs)
+
+        self.version = models.F('version') + 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'version', 'updated_at'}
+        res = super(UserState, self).save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+        return res
 
     class Meta:
         constraints = [
@@ -195,30 +240,44 @@ class Invitation(models.Model):
         self.cancel_reason = ''
         self.save()
 
+    # one UPDATE for the whole week, returns number of invitations reset
+    @classmethod
+    def reset_decisions(cls, year, week, users=None):
+        invitations = cls.objects.filter(year=year, week=week)
+        if users is not None:
+            invitations = invitations.filter(user__in=users)
+        return invitations.update(accepted=None, cancel_reason='')
+
+    # meetings are rearranged in background, bursts of decisions are coalesced into one run
     def trigger_rearrange_meetings(self):
-        return Invitation.rearrange_meeetings(year=self.year, week=self.week)
+        from .scheduler import RematchScheduler
+
+        telegram_id = None
+        if settings.RANDOM_COFFEE_PLATFORM.get('INCREMENTAL_REMATCH', True):
+            telegram_id = self.user.telegram_id
+        RematchScheduler.schedule(year=self.year, week=self.week, telegram_id=telegram_id)
 
+    # if telegram_id is given, only meetings of this user are repaired, otherwise whole week is rearranged
     @classmethod
-    def rearrange_meeetings(cls, year=None, week=None):
+    def rearrange_meeetings(cls, year=None, week=None, telegram_id=None, seed=None):
         if year is None or week is None:
             raise Exception('year or week are undefined')
         if not Meeting.were_details_broadcasted(year=year, week=week):
-            if Meeting.objects.filter(year=year, week=week).count() > 0:
-                Meeting.objects.filter(year=year, week=week).delete()
+            if telegram_id is not None and Meeting.objects.filter(year=year, week=week).exists():
+                from .blender import repair_meetings
+                meetings_obj = repair_meetings(year=year, week=week, telegram_id=telegram_id, seed=seed)
+
+                Meeting.write_schedule(year=year, week=week, meetings=meetings_obj['meetings'], meetings_removed=meetings_obj['removed'])
+                return meetings_obj
 
             from .blender import arrange_meetings
-            meetings_obj = arrange_meetings(year=year, week=week)
+            meetings_obj = arrange_meetings(year=year, week=week, seed=seed)
 
             if meetings_obj != {}:
-                for m in meetings_obj['meetings']:
-                    Meeting(
-                        year=year,
-                        week=week,
-                        user_a_telegram_id=m[0],
-                        user_b_telegram_id=m[1]
-                    ).save()
+                Meeting.write_schedule(year=year, week=week, meetings=meetings_obj['meetings'], replace=True)
                 return meetings_obj
             else:
+                Meeting.write_schedule(year=year, week=week, meetings=[], replace=True)
                 logger.info("Couldnt make meetings to satisfy demand")
                 return {}
         else:
@@ -285,6 +344,19 @@ class Meeting(models.Model):
             self.user_b_meeting_failure_reason = ''
         self.save()
 
+    # feedback of all participants of the week in one UPDATE
+    @classmethod
+    def reset_feedback(cls, year, week):
+        return cls.objects.filter(year=year, week=week).update(
+            user_a_meeting_took_place=None,
+            user_b_meeting_took_place=None,
+            user_a_happy=None,
+            user_b_happy=None,
+            user_a_meeting_failure_reason='',
+            user_b_meeting_failure_reason='',
+            updated_at=django.utils.timezone.now()
+        )
+
     # partner is another person from user with telegram_id=user_telegram_id
     def get_partner_id(self, user_telegram_id):
         if not user_telegram_id in [self.user_a_telegram_id, self.user_b_telegram_id]:
@@ -296,7 +368,37 @@ class Meeting(models.Model):
 
     @classmethod
     def were_details_broadcasted(cls, year, week):
-        return Meeting.objects.filter(broadcasted_at__isnull=False).count() > 0
+        # weeks broadcasted before broadcasts were tracked only have broadcasted_at stamps
+        return Broadcast.objects.filter(year=year, week=week).exists() or \
+               Meeting.objects.filter(year=year, week=week, broadcasted_at__isnull=False).exists()
+
+    # one transaction, so readers never see a half-written week
+    @classmethod
+    def write_schedule(cls, year, week, meetings, meetings_removed=None, replace=False):
+        now = django.utils.timezone.now()
+
+        with transaction.atomic():
+            if replace:
+                cls.objects.filter(year=year, week=week).delete()
+
+            if meetings_removed is not None and len(meetings_removed) > 0:
+                q = Q()
+                for m in meetings_removed:
+                    q |= (Q(user_a_telegram_id=m[0]) & Q(user_b_telegram_id=m[1])) | \
+                         (Q(user_a_telegram_id=m[1]) & Q(user_b_telegram_id=m[0]))
+                cls.objects.filter(Q(year=year) & Q(week=week) & q).delete()
+
+            # bulk_create doesn't call save(), so timestamps are stamped here
+            cls.objects.bulk_create([
+                Meeting(
+                    year=year,
+                    week=week,
+                    user_a_telegram_id=m[0],
+                    user_b_telegram_id=m[1],
+                    created_at=now,
+                    updated_at=now
+                ) for m in meetings
+            ])
 
     @classmethod
     def get_participants_id(cls, year, week):
@@ -344,6 +446,74 @@ class Meeting(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['week', 'year', 'user_a_telegram_id', 'user_b_telegram_id'], name='unique_meeting')
         ]
+        indexes = [
+            models.Index(fields=['user_a_telegram_id'], name='meeting_user_a_idx'),
+            models.Index(fields=['user_b_telegram_id'], name='meeting_user_b_idx'),
+        ]
+
+
+# mailing of meeting details for the week, interrupted one is resumed from where it stopped
+class Broadcast(models.Model):
+    week = models.IntegerField(blank=False)
+    year = models.IntegerField(blank=False)
+
+    created_at = models.DateTimeField(default=django.utils.timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def is_finished(self):
+        return self.finished_at is not None
+
+    def __str__(self):
+        return "w%dy%d" % (self.week, self.year)
+
+    # recipients are fixed when the broadcast starts, meetings can't be rearranged after that
+    @classmethod
+    def get_or_create_for_week(cls, year, week):
+        with transaction.atomic():
+            broadcast, created = cls.objects.get_or_create(year=year, week=week)
+            if created:
+                BroadcastDelivery.objects.bulk_create([
+                    BroadcastDelivery(broadcast=broadcast, user_telegram_id=p_id)
+                    for p_id in Meeting.get_participants_id(year=year, week=week)
+                ])
+        return broadcast
+
+    def get_progress(self):
+        progress = {status: 0 for status, label in DELIVERY_STATUS_CHOICES}
+        for row in self.deliveries.values('status').annotate(total=models.Count('id')):
+            progress[row['status']] = row['total']
+
+        return {
+            'total': sum(progress.values()),
+            'pending': progress[PENDING],
+            'sent': progress[SENT],
+            'failed': progress[FAILED],
+            'retrying': progress[RETRYING],
+            'finished': self.is_finished
+        }
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['week', 'year'], name='unique_broadcast')
+        ]
+
+
+class BroadcastDelivery(models.Model):
+    broadcast = models.ForeignKey(Broadcast, related_name='deliveries', on_delete=models.CASCADE)
+    user_telegram_id = models.CharField(blank=False, max_length=100)
+
+    status = models.CharField(max_length=1, default=PENDING, choices=DELIVERY_STATUS_CHOICES)
+    attempts = models.IntegerField(default=0)
+    error = models.CharField(blank=True, default='', max_length=500)
+
+    sent_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(default=django.utils.timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'user_telegram_id'], name='unique_broadcast_delivery')
+        ]
 
 
 class Feedback(models.Model):
@@ -365,8 +535,52 @@ class Message(models.Model):
     message_id = models.CharField(null=True, max_length=100)
     sent_at = models.DateTimeField(default=django.utils.timezone.now)
 
+    # ISO week of sent_at, messages are archived week by week
+    week = models.IntegerField(null=True, blank=True)
+    year = models.IntegerField(null=True, blank=True)
+
+    def set_iso_week(self):
+        self.year, self.week = Clock.get_iso_week(django.utils.timezone.localtime(self.sent_at))
+
     def save(self, *args, **kwargs):
         if self._state.adding:
             self.sent_at = django.utils.timezone.now()
+            self.set_iso_week()
 
         return super(Message, self).save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['year', 'week'], name='message_week_idx'),
+            models.Index(fields=['sent_at'], name='message_sent_at_idx'),
+            models.Index(fields=['user', 'sent_at'], name='message_user_sent_at_idx'),
+        ]
+
+
+# messages of the week moved out of Message table into gzipped JSON lines file
+class MessageArchive(models.Model):
+    week = models.IntegerField(blank=False)
+    year = models.IntegerField(blank=False)
+
+    file_path = models.CharField(max_length=500)
+    messages_count = models.IntegerField(default=0)
+    size_bytes = models.IntegerField(default=0)
+
+    created_at = models.DateTimeField(default=django.utils.timezone.now)
+    updated_at = models.DateTimeField(default=django.utils.timezone.now)
+
+    def __str__(self):
+        return "w%dy%d" % (self.week, self.year)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.created_at = django.utils.timezone.now()
+
+        self.updated_at = django.utils.timezone.now()
+
+        return super(MessageArchive, self).save(*args, **kwargs)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['week', 'year'], name='unique_message_archive')
+        ]
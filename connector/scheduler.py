@@ -0,0 +1,99 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .db import closes_connection
+
+import logging
+logger = logging.getLogger('connector.apps')
+
+
+# bursts of requests to rearrange meetings of the same week are coalesced into one run on a worker thread
+class RematchScheduler:
+    _lock = threading.Lock()
+    _pending = {}
+    _running = {}
+
+    @classmethod
+    def get_debounce_seconds(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('REMATCH_DEBOUNCE_SECONDS', 5)
+
+    @classmethod
+    def get_max_delay_seconds(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('REMATCH_MAX_DELAY_SECONDS', 60)
+
+    @classmethod
+    def get_incremental_limit(cls):
+        return settings.RANDOM_COFFEE_PLATFORM.get('INCREMENTAL_REMATCH_LIMIT', 10)
+
+    # telegram_id=None means whole week has to be rearranged
+    @classmethod
+    def schedule(cls, year, week, telegram_id=None):
+        key = (year, week)
+
+        if cls.get_debounce_seconds() <= 0:
+            cls._run(key, {'telegram_ids': set() if telegram_id is None else {telegram_id}, 'full': telegram_id is None})
+            return
+
+        with cls._lock:
+            job = cls._pending.get(key)
+            if job is None:
+                job = {'telegram_ids': set(), 'full': False, 'created_at': time.time(), 'timer': None}
+                cls._pending[key] = job
+
+            if telegram_id is None:
+                job['full'] = True
+            else:
+                job['telegram_ids'].add(str(telegram_id))
+
+            # quiet period starts over, but the run is never postponed for longer than max delay
+            delay = cls.get_debounce_seconds()
+            delay = min(delay, max(0, job['created_at'] + cls.get_max_delay_seconds() - time.time()))
+
+            if job['timer'] is not None:
+                job['timer'].cancel()
+            job['timer'] = threading.Timer(delay, cls._fire, args=[key])
+            job['timer'].start()
+
+    @classmethod
+    @closes_connection
+    def _fire(cls, key):
+        with cls._lock:
+            job = cls._pending.pop(key, None)
+        if job is None:
+            return
+
+        cls._run(key, job)
+
+    @classmethod
+    def _run(cls, key, job):
+        from .models import Invitation, Meeting
+
+        with cls._lock:
+            run_lock = cls._running.setdefault(key, threading.Lock())
+
+        year, week = key
+        with run_lock:
+            try:
+                if job['full'] or len(job['telegram_ids']) > cls.get_incremental_limit() or \
+                        not Meeting.objects.filter(year=year, week=week).exists():
+                    logger.info("rearranging meetings for year=%d, week=%d" % (year, week))
+                    Invitation.rearrange_meeetings(year=year, week=week)
+                else:
+                    for telegram_id in job['telegram_ids']:
+                        logger.info("repairing meetings of %s for year=%d, week=%d" % (telegram_id, year, week))
+                        Invitation.rearrange_meeetings(year=year, week=week, telegram_id=telegram_id)
+            except Exception as e:
+                logger.error(e)
+
+    # runs everything pending right now, used by management commands before they exit
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            jobs = list(cls._pending.items())
+            cls._pending = {}
+
+        for key, job in jobs:
+            job['timer'].cancel()
+            cls._run(key, job)
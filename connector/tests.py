@@ -0,0 +1,42 @@
+from django.test import TestCase
+
+from .blender import arrange_meetings
+from .models import Group, User, Invitation, Meeting
+from .vars import *
+
+
+class ArrangeMeetingsQueriesTest(TestCase):
+    year = 2020
+    week = 10
+
+    def add_participants(self, count):
+        groups = [Group.objects.get_or_create(name='Company %d' % i)[0] for i in range(0, 3)] + [None]
+        first = User.objects.count()
+
+        for i in range(first, first + count):
+            user = User.objects.create(
+                telegram_id=str(100000 + i),
+                first_name='User %d' % i,
+                gender=[MALE, FEMALE][i % 2],
+                group=groups[i % len(groups)],
+                meeting_frequency=[HIGH, MEDIUM, LOW][i % 3],
+                meeting_motivation=[DATING, NETWORKING, HAVING_FUN][i % 3]
+            )
+            Invitation.objects.create(user=user, year=self.year, week=self.week, accepted=True)
+
+            # history of past meetings and participants of the previous week
+            if i > 0:
+                Meeting.objects.create(year=self.year, week=self.week - 1 - i % 2,
+                                       user_a_telegram_id=str(100000 + i - 1), user_b_telegram_id=user.telegram_id,
+                                       user_a_meeting_took_place=True)
+
+    # profiles, history and participants of the previous week are fetched with one query each
+    def test_query_count_does_not_grow_with_participants(self):
+        for count in (20, 60):
+            self.add_participants(count)
+
+            with self.assertNumQueries(3):
+                res = arrange_meetings(year=self.year, week=self.week, seed=0)
+
+            self.assertEqual(len(res['profiles']), User.objects.count())
+            self.assertTrue(len(res['meetings']) > 0)
@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+from telegram.error import RetryAfter, TimedOut, NetworkError
+
+from .db import closes_connection
+
+import logging
+logger = logging.getLogger('connector.apps')
+
+
+# allows rate events per second on average with bursts up to capacity events
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # returns how long to wait before the token is available, takes it if it's available right now
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# global budget of the bot plus budget of every chat, Telegram limits both
+class RateLimiter:
+    def __init__(self, rate=None, per_chat_rate=None):
+        if rate is None:
+            rate = settings.RANDOM_COFFEE_PLATFORM.get('BROADCAST_RATE', 25)
+        if per_chat_rate is None:
+            per_chat_rate = settings.RANDOM_COFFEE_PLATFORM.get('BROADCAST_PER_CHAT_RATE', 1)
+
+        self.per_chat_rate = per_chat_rate
+        self.bucket = TokenBucket(rate)
+        self.chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def get_chat_bucket(self, chat_id):
+        with self._lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+            return self.chat_buckets[chat_id]
+
+    def acquire(self, chat_id):
+        self.get_chat_bucket(chat_id).acquire()
+        self.bucket.acquire()
+
+    # Telegram asked to slow down, nobody sends anything until the time is over
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+
+_STOP = object()
+
+
+# calls send(item) for every item on worker threads within rate limits, returns failed items with their exceptions
+def fan_out(items, send, chat_id, limiter=None, workers=None, max_retries=None):
+    if limiter is None:
+        limiter = RateLimiter()
+    if workers is None:
+        workers = settings.RANDOM_COFFEE_PLATFORM.get('BROADCAST_WORKERS', 8)
+    if max_retries is None:
+        max_retries = settings.RANDOM_COFFEE_PLATFORM.get('BROADCAST_MAX_RETRIES', 3)
+    workers = max(1, workers)
+
+    tasks = queue.Queue(maxsize=workers * 4)
+
+    failed = {}
+    failed_lock = threading.Lock()
+
+    def send_with_retries(item):
+        attempt = 0
+        while True:
+            limiter.acquire(chat_id(item))
+            try:
+                send(item)
+                return
+            except RetryAfter as e:
+                logger.info("flood control exceeded, retrying in %s seconds" % e.retry_after)
+                limiter.pause(e.retry_after)
+            except (TimedOut, NetworkError):
+                if attempt >= max_retries:
+                    raise
+                time.sleep(2 ** attempt)
+                attempt += 1
+
+    @closes_connection
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                return
+            try:
+                send_with_retries(item)
+            except Exception as e:
+                logger.error(e)
+                with failed_lock:
+                    failed[item] = e
+
+    threads = [threading.Thread(target=work) for i in range(0, workers)]
+    for t in threads:
+        t.start()
+
+    try:
+        for item in items:
+            tasks.put(item)
+    finally:
+        for t in threads:
+            tasks.put(_STOP)
+        for t in threads:
+            t.join()
+
+    return failed
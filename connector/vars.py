@@ -92,3 +92,16 @@ ARRANGEMENT_FAILURE_REASONS = [
     (COULDNT_ARRANGE, COULDNT_ARRANGE_REPLY),
     (FORCED_MAJOR, FORCED_MAJOR_REPLY)
 ]
+
+
+PENDING = 'P'
+SENT = 'S'
+FAILED = 'F'
+RETRYING = 'R'
+
+DELIVERY_STATUS_CHOICES = [
+    (PENDING, 'Ожидает отправки'),
+    (SENT, 'Отправлено'),
+    (FAILED, 'Не доставлено'),
+    (RETRYING, 'Отправляется'),
+]
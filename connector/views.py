@@ -11,9 +11,10 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 
 from django.conf import settings
+from django.db.models import Exists, OuterRef, Subquery, Case, When, Value, F, Q, BooleanField, NullBooleanField
 
 
-from .models import User, Invitation, Meeting
+from .models import User, Invitation, Meeting, Broadcast
 from .clock import Clock
 
 import telegram
@@ -91,10 +92,12 @@ def schedule(request):
         }
     }
 
-    users = User.objects.all()
-
-    invitatons = Invitation.objects.filter(year=year, week=week)
-    invited_users_id = list(map(lambda x: x.user.telegram_id, invitatons))
+    # whole funnel in one query: users with their group and decision on the week's invitation
+    invitation = Invitation.objects.filter(user=OuterRef('pk'), year=year, week=week)
+    users = list(User.objects.select_related('group').annotate(
+        invited=Exists(invitation),
+        invitation_accepted=Subquery(invitation.values('accepted')[:1])
+    ))
 
     user_funnel = {
         'accepted': [],
@@ -110,12 +113,12 @@ def schedule(request):
         funnel_stage = 'undefined'
         if u.enabled:
             if u.finished_registration:
-                if u.telegram_id in invited_users_id:
-                    if invitatons.get(user=u).accepted is None:
+                if u.invited:
+                    if u.invitation_accepted is None:
                         funnel_stage = 'thinking'
-                    elif invitatons.get(user=u).accepted:
+                    elif u.invitation_accepted:
                         funnel_stage = 'accepted'
-                    elif not invitatons.get(user=u).accepted:
+                    elif not u.invitation_accepted:
                         funnel_stage = 'declined'
                 else:
                     funnel_stage = 'awaiting_invitation'
@@ -126,22 +129,41 @@ def schedule(request):
 
         user_funnel[funnel_stage].append(u.as_tuple())
 
-    meetings_queryset = Meeting.objects.filter(year=year, week=week)
+    # participants are taken from users loaded above, aggregated feedback is computed by the database
+    # the same way as Meeting.meeting_took_place_aggregated and Meeting.meeting_was_ok_aggregated do
+    users_dict = {u.telegram_id: u for u in users}
+    meetings_queryset = Meeting.objects.filter(year=year, week=week).annotate(
+        took_place=Case(
+            When(Q(user_a_meeting_took_place=True) | Q(user_b_meeting_took_place=True), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField()
+        ),
+        was_ok=Case(
+            When(user_a_happy=True, then=Value(True)),
+            default=F('user_b_happy'),
+            output_field=NullBooleanField()
+        )
+    ).values_list('user_a_telegram_id', 'user_b_telegram_id', 'took_place', 'was_ok')
+
     meetings = []
-    for m in meetings_queryset:
-        user_a = User.objects.get(telegram_id=m.user_a_telegram_id)
-        user_b = User.objects.get(telegram_id=m.user_b_telegram_id)
-        meetings.append([user_a.as_tuple(), user_b.as_tuple(), m.meeting_took_place_aggregated, m.meeting_was_ok_aggregated])
+    for user_a_telegram_id, user_b_telegram_id, took_place, was_ok in meetings_queryset:
+        user_a = users_dict[user_a_telegram_id]
+        user_b = users_dict[user_b_telegram_id]
+        meetings.append([user_a.as_tuple(), user_b.as_tuple(), took_place, was_ok])
 
     meeting_details_broadcasted = Meeting.were_details_broadcasted(year, week)
 
+    broadcast = Broadcast.objects.filter(year=year, week=week).first()
+    broadcast_progress = broadcast.get_progress() if broadcast is not None else None
+
     return render(request, 'schedule.html', {
-        'total_users': users.count(),
+        'total_users': len(users),
         "timestamps": timestamps,
         "users": user_funnel,
         "statistics": User.statistics(),
         "meetings": meetings,
-        "meeting_details_broadcasted": meeting_details_broadcasted
+        "meeting_details_broadcasted": meeting_details_broadcasted,
+        "broadcast_progress": broadcast_progress
     })
 
 
@@ -153,6 +175,9 @@ def shuffle_meetings(request):
             year = int(request.data['year'])
             week = int(request.data['week'])
             ignore_time_flow = request.data['ignore_time_flow']
+            seed = request.data.get('seed', None)
+            if seed is not None:
+                seed = int(seed)
         except Exception as e:
             return HttpResponseBadRequest()
 
@@ -161,6 +186,9 @@ def shuffle_meetings(request):
             year = int(request.query_params['year'])
             week = int(request.query_params['week'])
             ignore_time_flow = request.query_params['ignore_time_flow']
+            seed = request.query_params.get('seed', None)
+            if seed is not None:
+                seed = int(seed)
         except Exception as e:
             return HttpResponseBadRequest()
 
@@ -170,8 +198,7 @@ def shuffle_meetings(request):
     monday_upcoming_week = Clock.get_monday_same_week_by_year_and_week(year=year_upcoming, week=week_upcoming)
 
     if monday_requested_week >= monday_upcoming_week or ignore_time_flow:
-        meetings_obj = Invitation.rearrange_meeetings(year=year, week=week)
-        logger.info(meetings_obj)
+        meetings_obj = Invitation.rearrange_meeetings(year=year, week=week, seed=seed)
 
         return JsonResponse(meetings_obj, status=200)
     else:
@@ -213,8 +240,7 @@ def resend_invitation(request):
             )
             inv.reset_decision()
             # need to rearrange because we now user's decision is undefined
-            meetings_obj = inv.trigger_rearrange_meetings()
-            logger.info(meetings_obj)
+            inv.trigger_rearrange_meetings()
 
         dialog = cb.get_dialog(user=u)
 
@@ -250,8 +276,7 @@ def connect_participants(request):
     cb = ChatbotConnector.get_bot(token=settings.RANDOM_COFFEE_PLATFORM.get('BOTS', [])[0]['TOKEN'])
 
     try:
-        if not Meeting.were_details_broadcasted(year, week):
-            broadacst_meeting_details(cb, year, week)
+        broadacst_meeting_details(cb, year, week)
 
         #TODO: return some data about sent meeting details
         return JsonResponse({}, status=200)
@@ -52,6 +52,67 @@ RANDOM_COFFEE_PLATFORM = {
     #'POLL_READ_LATENCY':(Optional[float|int]), # Grace time in seconds for receiving the reply from
                     #server. Will be added to the `timeout` value and used as the read timeout from
                     #server (Default: 2).
+    #'COMPATIBILITY_MODE':(Optional[str]), # How matrix of possible partners is computed before
+                    #matching: 'python' (default) or 'numpy' (vectorized, requires numpy)
+
+    #'MATCHING_SOLVER':(Optional[str]), # How meetings are arranged: 'shuffle' (default, best of
+                    #several random greedy passes) or 'max_matching' (maximum number of meetings
+                    #within participants' frequency)
+
+    #'INCREMENTAL_REMATCH':(Optional[bool]), # When a single participant changes their decision,
+                    #only meetings touching them are repaired instead of rearranging the whole
+                    #week. Default is True
+
+    #'REMATCH_DEBOUNCE_SECONDS':(Optional[int|float]), # Meetings are rearranged in background after
+                    #this many seconds without new decisions for the week. Default is 5,
+                    #0 rearranges meetings right away in the handler
+
+    #'REMATCH_MAX_DELAY_SECONDS':(Optional[int|float]), # A steady stream of decisions never
+                    #postpones rearrangement for longer than this. Default is 60
+
+    #'INCREMENTAL_REMATCH_LIMIT':(Optional[int]), # If more participants changed their decision
+                    #during the quiet period, the whole week is rearranged instead of
+                    #repairing meetings one by one. Default is 10
+
+    #'BROADCAST_RATE':(Optional[int|float]), # How many messages per second a bot sends during mass
+                    #mailing, Telegram allows about 30. Default is 25
+
+    #'BROADCAST_PER_CHAT_RATE':(Optional[int|float]), # How many messages per second a single chat
+                    #receives during mass mailing. Default is 1
+
+    #'BROADCAST_WORKERS':(Optional[int]), # How many threads send messages during mass mailing.
+                    #Default is 8
+
+    #'BROADCAST_MAX_RETRIES':(Optional[int]), # How many times a message is resent after a network
+                    #error before giving up. Default is 3
+
+    #'DIALOG_CACHE_SIZE':(Optional[int]), # How many dialogs a bot keeps in memory, the least recently
+                    #used ones are dropped first. Default is 1000
+
+    #'DIALOG_CACHE_TTL':(Optional[int|float]), # Dialog is dropped from memory after this many
+                    #seconds without messages. Default is 86400 (one day)
+
+    #'ACTIVITY_GRANULARITY_SECONDS':(Optional[int|float]), # User's last_seen_at is updated at most
+                    #once per this many seconds. Default is 60
+
+    #'ACTIVITY_FLUSH_SECONDS':(Optional[int|float]), # Collected last_seen_at timestamps are written
+                    #to the database this many seconds after the first of them. Default is 60
+
+    #'AUDIT_LOG_QUEUE_SIZE':(Optional[int]), # How many messages may wait to be written to the log,
+                    #messages beyond that are dropped and counted. Default is 10000
+
+    #'AUDIT_LOG_BATCH_SIZE':(Optional[int]), # How many messages are written to the log at once.
+                    #Default is 100
+
+    #'AUDIT_LOG_FLUSH_SECONDS':(Optional[int|float]), # Message waits at most this many seconds
+                    #before it's written to the log. Default is 2
+
+    #'MESSAGE_RETENTION_WEEKS':(Optional[int]), # How many recent weeks of messages are kept in the
+                    #database, older ones are moved to archive by archive_messages. Default is 12
+
+    #'MESSAGE_ARCHIVE_DIR':(Optional[str]), # Where archive_messages puts gzipped weekly files.
+                    #Default is 'archive' next to the database
+
 	'BOTS' : [
         {
             'COMMUNITY_NAME': '',